@@ -0,0 +1,314 @@
+""" asyncio interface to a Moodle connection
+
+The Moodle, Course and resource classes are built on top of a blocking
+requests.Session so every operation costs a full network round trip before
+the next one can start. The classes in this module wrap those objects and
+expose coroutines that run the blocking calls in a pool of worker threads,
+allowing many requests to be in flight at once while still sharing the
+URL building, sesskey harvesting and on-disk cache of the wrapped objects.
+
+The number of requests that are simultaneously sent to the server is
+limited by the `max_concurrency` of the AsyncMoodle object; be kind to
+the Moodle server.
+
+Example usage
+=============
+
+    >>> import asyncio
+    >>> from moodletools.aio import AsyncMoodle
+    >>> amoodle = AsyncMoodle(mymoodle, max_concurrency=8)
+    >>> course = amoodle.course(12345)
+    >>> asyncio.run(course.hide_all(types=['resource']))
+"""
+
+# Copyright (c) 2018 Stuart Prescott
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+from moodletools.utils import resid_factory
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMoodle:
+    """ asyncio wrapper around a Moodle connection instance
+
+    The blocking methods of the Moodle instance are run in a thread pool
+    with no more than `max_concurrency` of them running at any one time.
+
+    :param moodle: moodletools.moodle.Moodle, the logged in Moodle
+        connection to wrap
+    :param max_concurrency: int, optional, default 8.
+        The maximum number of requests to the server that may be in
+        progress at any one time.
+    """
+    def __init__(self, moodle, max_concurrency=8):
+        self.moodle = moodle
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._semaphore = None
+        self._loop = None
+
+    def _limits(self):
+        """ the concurrency limits for the currently running event loop
+
+        asyncio primitives are tied to the event loop in which they are
+        created, so they are recreated if the wrapper is used from within
+        a new loop (for example, with repeated asyncio.run calls).
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix='moodletools',
+            )
+        return loop, self._semaphore, self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """ run a blocking callable in the worker pool
+
+        All blocking work is funnelled through this method so that the
+        concurrency cap is applied to everything that talks to the server.
+        """
+        loop, semaphore, executor = self._limits()
+        async with semaphore:
+            return await loop.run_in_executor(
+                executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        """ shut down the worker pool """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @property
+    def base_url(self):
+        return self.moodle.base_url
+
+    @property
+    def has_sesskey(self):
+        return self.moodle.has_sesskey
+
+    def url(self, path):
+        """ create a URL for a resource within this Moodle installation """
+        return self.moodle.url(path)
+
+    async def sesskey(self):
+        """ return the sesskey for the session """
+        if self.moodle.has_sesskey:
+            return self.moodle.sesskey()
+        return await self.run(self.moodle.sesskey)
+
+    async def get_dashboard_page(self, resid='auto'):
+        """ return a requests.Response object for the site dashboard page
+
+        See :meth:`moodletools.moodle.Moodle.get_dashboard_page`.
+        """
+        return await self.run(self.moodle.get_dashboard_page, resid)
+
+    async def fetch(self, resource_path, resid=None, force=False):
+        """ return a requests.Response object for the requested URL
+
+        See :meth:`moodletools.moodle.Moodle.fetch`.
+        """
+        return await self.run(self.moodle.fetch, resource_path,
+                              resid=resid, force=force)
+
+    async def fetch_from_form(self, form_path, resource_path,
+                              payload_filter, resid=None, force=False,
+                              files=None, form_name='mform1',
+                              template=None):
+        """ return a requests.Response object for a form submission
+
+        See :meth:`moodletools.moodle.Moodle.fetch_from_form`.
+        """
+        return await self.run(self.moodle.fetch_from_form,
+                              form_path, resource_path, payload_filter,
+                              resid=resid, force=force, files=files,
+                              form_name=form_name, template=template)
+
+    def course(self, course_id):
+        """ create an AsyncCourse object for the specified course id
+
+        course_id: course id number
+        """
+        return AsyncCourse(self.moodle.course(course_id), self)
+
+
+class AsyncCourse:
+    """ asyncio wrapper around a Course within a Moodle installation
+
+    :param course: moodletools.course.Course, the course to wrap
+    :param amoodle: AsyncMoodle, the wrapper of the course's Moodle instance
+    """
+    def __init__(self, course, amoodle):
+        self.course = course
+        self.amoodle = amoodle
+
+    @property
+    def id(self):
+        return self.course.id
+
+    def _wrap(self, resource):
+        return AsyncResource(resource, self.amoodle)
+
+    def activity(self, activity_id):
+        """ create an AsyncResource for a generic activity """
+        return self._wrap(self.course.activity(activity_id))
+
+    def assignment(self, assignment_id):
+        """ create an AsyncResource for an Assignment activity """
+        return self._wrap(self.course.assignment(assignment_id))
+
+    def database(self, database_id):
+        """ create an AsyncResource for a Database activity """
+        return self._wrap(self.course.database(database_id))
+
+    def page(self, page_id):
+        """ create an AsyncResource for a Page activity """
+        return self._wrap(self.course.page(page_id))
+
+    def label(self, label_id):
+        """ create an AsyncResource for a Label activity """
+        return self._wrap(self.course.label(label_id))
+
+    def workshep(self, workshep_id):
+        """ create an AsyncResource for a Workshep activity """
+        return self._wrap(self.course.workshep(workshep_id))
+
+    def forum(self, forum_id):
+        """ create an AsyncResource for a Forum activity """
+        return self._wrap(self.course.forum(forum_id))
+
+    def resource(self, resource_id):
+        """ create an AsyncResource for a File Resource """
+        return self._wrap(self.course.resource(resource_id))
+
+    async def get_course_page(self, resid='auto'):
+        """ return a requests.Response object for the course page """
+        return await self.amoodle.run(self.course.get_course_page, resid)
+
+    async def get_logs(self, activity_id, resid='auto'):
+        """ fetch the logs for a specified activity """
+        return await self.amoodle.run(self.course.get_logs,
+                                      activity_id, resid)
+
+    async def list_all(self, types=None):
+        """ list all resources that are shown on the course page
+
+        See :meth:`moodletools.course.Course.list_all`.
+        """
+        return await self.amoodle.run(self.course.list_all, types)
+
+    async def list_section(self, section, types=None):
+        """ list the resources within one section of the course
+
+        See :meth:`moodletools.course.Course.list_section`.
+        """
+        return await self.amoodle.run(self.course.list_section,
+                                      section, types)
+
+    async def sections(self, types=None):
+        """ list the resources within each section of the course
+
+        The sections are found as in :meth:`moodletools.course.Course.sections`
+        and the pages for the remaining sections are fetched concurrently.
+
+        returns: list of (int, list of CourseResource)
+            the section number and the resources in it, in section order
+        """
+        first = await self.amoodle.run(self.course.get_section_page, 1)
+        numbers, found = await self.amoodle.run(
+            self.course._discover_sections, first, types)
+
+        async def _list(section):
+            if section in found:
+                return found[section]
+            return await self.list_section(section, types) or []
+
+        results = await asyncio.gather(*[_list(n) for n in numbers])
+        return list(zip(numbers, results))
+
+    async def quick_action(self, resource_id, action):
+        """ run a quick link for a resource """
+        # ensure the sesskey is known before requests are sent in parallel
+        await self.amoodle.sesskey()
+        return await self.amoodle.run(self.course.quick_action,
+                                      resource_id, action)
+
+    async def quick_action_all(self, types, action):
+        """ run an action for all resources of a certain type concurrently
+
+        See :meth:`moodletools.course.Course.quick_action_all`.
+
+        returns: list of CourseResource
+            the entries that were successfully processed; failures are
+            logged and omitted from the list
+        """
+        acts = await self.amoodle.run(self.course._quick_action_targets,
+                                      types, action)
+        await self.amoodle.sesskey()
+        results = await asyncio.gather(*[
+            self.quick_action(a.id, action) for a in acts
+        ], return_exceptions=True)
+
+        done = []
+        for act, result in zip(acts, results):
+            if isinstance(result, Exception):
+                logger.error("Action '%s' failed for activity %s: %s",
+                             action, act.id, result)
+            else:
+                done.append(act)
+
+        if done:
+            # the cached course page no longer reflects the course
+            self.amoodle.moodle.invalidate(
+                resid_factory(self.course, "course-page-{id}"))
+        return done
+
+    async def hide_all(self, types=None):
+        """ hide all resources of a certain type on the course page """
+        return await self.quick_action_all(types, 'hide')
+
+    async def unhide_all(self, types=None):
+        """ unhide all resources of a certain type on the course page """
+        return await self.quick_action_all(types, 'show')
+
+
+class AsyncResource:
+    """ asyncio wrapper around an activity within a course
+
+    Every public method of the wrapped resource is available as a coroutine
+    that is run within the worker pool of the AsyncMoodle instance.
+
+    >>> assgt = acourse.assignment(2468)
+    >>> status = await assgt.get_submission_status()
+    """
+    def __init__(self, resource, amoodle):
+        self.resource = resource
+        self.amoodle = amoodle
+
+    @property
+    def id(self):
+        return self.resource.id
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        attr = getattr(self.resource, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def _method(*args, **kwargs):
+            return await self.amoodle.run(attr, *args, **kwargs)
+
+        return _method
@@ -4,12 +4,15 @@
 
 # Copyright (c) 2017-2018 Stuart Prescott
 
+import collections
 import logging
 import os.path
 
 import moodletools
 import moodletools.config
 import moodletools.course
+import moodletools.mirror
+import moodletools.utils
 
 logger = logging.getLogger(__name__)
 
@@ -118,6 +121,12 @@ class CoursePage(AbstractCommand):
             help='list all activities, optionally saving as a spreadsheet',
         )
 
+        parser.add_argument(
+            '--jobs', metavar='N', type=int, default=1,
+            help='number of requests to send to the server in parallel '
+                 'when changing many activities',
+        )
+
         return parser
 
     def handler(self, args, config):
@@ -148,16 +157,18 @@ class CoursePage(AbstractCommand):
                 df.to_excel(filename)
         elif args.show_all:
             logging.debug("Showing all resources")
-            activities = c.unhide_all()
+            activities = c.unhide_all(jobs=args.jobs)
+            print("Shown %d activities" % len(activities))
         elif args.hide_all:
             logging.debug("Hiding all resources")
-            activities = c.hide_all()
+            activities = c.hide_all(jobs=args.jobs)
+            print("Hidden %d activities" % len(activities))
         elif args.hide:
             raise NotImplementedError
         elif args.show:
             raise NotImplementedError
-
-        raise ValueError("Unknown action for subcommand")
+        else:
+            raise ValueError("Unknown action for subcommand")
 
 
 class Assignment(AbstractCommand):
@@ -176,7 +187,6 @@ class Assignment(AbstractCommand):
         parser.add_argument(
             '--id', metavar="ID",
             help='download the resource with the specified Id',
-            required=True,
         )
 
         # Mutually exclusive options for page
@@ -187,11 +197,29 @@ class Assignment(AbstractCommand):
             help='save assignment status information into FILENAME',
         )
 
+        group.add_argument(
+            '--all', metavar="FILENAME.xlsx", type=str,
+            help='save the status and grades of every assignment in the '
+                 'course into FILENAME',
+        )
+
         group.add_argument(
             '--grades', metavar="FILENAME.xlsx", type=str,
             help='save assignment grade information into FILENAME (includes '
                  'unreleased grades)',
         )
+
+        parser.add_argument(
+            '--perpage', metavar='N',
+            help='rows per page when fetching the grading table, or "all" '
+                 '(default from the configuration)',
+        )
+
+        parser.add_argument(
+            '--jobs', metavar='N', type=int, default=4,
+            help='number of assignments to fetch in parallel with --all '
+                 '(default 4)',
+        )
         return parser
 
     def handler(self, args, config):
@@ -205,19 +233,31 @@ class Assignment(AbstractCommand):
         print(args)
         _, c = moodletools.config.auto_start(config)
 
+        perpage = args.perpage or config.assignment_perpage
+
+        if args.all:
+            logging.debug("All assignments status")
+            df = c.assignments_status(args.jobs, config.cache_force, perpage)
+            filename = args.all
+            logging.debug("Writing to file '%s'", filename)
+            df.to_excel(filename, index=False)
+            return
+
         rid = resource_id(args, config)
+        if rid is None:
+            raise ValueError("An assignment id must be specified with --id")
         assgt = c.assignment(rid)
 
         # actions are mutually exclusive
         if args.status:
             logging.debug("Assignment status")
-            df = assgt.get_submission_status(config.cache_force)
+            df = assgt.get_submission_status(config.cache_force, perpage)
             filename = args.status
             logging.debug("Writing to file '%s'", filename)
             df.to_excel(filename)
         elif args.grades:
             logging.debug("Assignment grades")
-            df = assgt.get_grades(config.cache_force)
+            df = assgt.get_grades(config.cache_force, perpage)
             filename = args.grades
             logging.debug("Writing to file '%s'", filename)
             df.to_excel(filename)
@@ -418,10 +458,38 @@ class Resource(AbstractCommand):
                  'filename',
         )
 
+        group.add_argument(
+            '--fetch-all', metavar='DIR',
+            help='download all file resources and folders in the course '
+                 'into the directory DIR',
+        )
+
+        group.add_argument(
+            '--put', metavar='FILENAME',
+            help='upload FILENAME to replace the file in the resource',
+        )
+
+        group.add_argument(
+            '--sync', metavar='DIR',
+            help='update the copy of the file resources and folders of the '
+                 'course in the directory DIR, downloading only new or '
+                 'changed files',
+        )
+
         parser.add_argument(
             '--id', metavar="ID",
             help='download the resource with the specified Id',
-            required=True,
+        )
+
+        parser.add_argument(
+            '--progress', action='store_true',
+            help='show the progress of the download or upload',
+        )
+
+        parser.add_argument(
+            '--jobs', metavar='N', type=int, default=4,
+            help='number of files to download in parallel with --fetch-all '
+                 'or --sync (default 4)',
         )
 
         return parser
@@ -437,14 +505,156 @@ class Resource(AbstractCommand):
         print(args)
         _, c = moodletools.config.auto_start(config)
 
-        rid = resource_id(args, config)
+        def _report(activity, filename, status):
+            print("%-10s %s %s" % (status, activity.id,
+                                   filename or activity.name))
 
         # actions are mutually exclusive
+        if args.fetch_all:
+            logging.debug("Fetch all resources")
+
+            results = c.download_all(args.fetch_all, jobs=args.jobs,
+                                     progress=_report)
+            counts = collections.Counter(r.status for r in results)
+            print("Downloaded %d, skipped %d, failed %d" % (
+                counts['downloaded'], counts['skipped'], counts['failed']))
+            return
+
+        if args.sync:
+            logging.debug("Synchronise resources")
+
+            mirror = moodletools.mirror.CourseMirror(c, args.sync)
+            results = mirror.sync(jobs=args.jobs, progress=_report)
+            counts = collections.Counter(r.status for r in results)
+            print("New %d, changed %d, unchanged %d, deleted %d, failed %d" %
+                  (counts['new'], counts['changed'], counts['unchanged'],
+                   counts['deleted'], counts['failed']))
+            return
+
+        rid = resource_id(args, config)
+        if rid is None:
+            raise ValueError("A resource id must be specified with --id")
+
         if args.fetch:
             logging.debug("Fetch the resource")
 
             filename = args.fetch
 
             resource = c.resource(rid)
-            resource.get(save=True, filename=filename)
-            # FIXME: skip cache?
+            progress = _print_progress if args.progress else None
+            resource.get(save=True, filename=filename, stream=True,
+                         progress=progress)
+            if progress:
+                print()
+
+        elif args.put:
+            logging.debug("Upload to the resource")
+
+            resource = c.resource(rid)
+            progress = _print_progress if args.progress else None
+            resource.put(args.put, progress=progress)
+            if progress:
+                print()
+
+
+class Cache(AbstractCommand):
+
+    def add_parser(self, subparsers):
+        """ Subcommand: cache """
+        parser = subparsers.add_parser(
+            'cache',
+            description='The cache command provides tools for inspecting '
+                        'and tidying the on-disk cache of downloaded '
+                        'resources.',
+            help="tools for managing the on-disk cache"
+        )
+
+        parser.add_argument(
+            'action', choices=['gc', 'stats'],
+            help='"gc" evicts entries to bring the cache within its budget '
+                 'and removes unused files; "stats" reports on the usage '
+                 'of the cache',
+        )
+
+        parser.add_argument(
+            '--max-age', metavar='SECONDS', type=int,
+            help='(gc) also remove entries older than SECONDS',
+        )
+
+        parser.add_argument(
+            '--top', metavar='N', type=int, default=10,
+            help='(stats) number of the largest entries to list',
+        )
+
+        return parser
+
+    def handler(self, args, config):
+        """ Dispatcher for 'cache' commands
+
+        :param args: argparse.Namespace object of command-line options
+        :param config: moodletools.config.MtConfig collection of configuration
+            options
+        """
+        logging.debug("Cache tools")
+
+        location = config.cache_location
+        if location is None or not os.path.isdir(location):
+            print("No cache found")
+            return
+
+        store = moodletools.utils.CacheStore.open(
+            location,
+            config.cache_max_bytes,
+            config.cache_max_entries,
+        )
+
+        if args.action == 'gc':
+            logging.debug("Garbage collecting cache")
+            removed, orphans = store.gc(args.max_age)
+            print("Removed %d entries and %d unused files" %
+                  (removed, orphans))
+        elif args.action == 'stats':
+            logging.debug("Cache statistics")
+            stats = store.stats(args.top)
+            hit_rate = stats['hit_rate']
+            print("Location:     %s" % location)
+            print("Entries:      %d (limit %s)" %
+                  (stats['entries'], stats['max_entries']))
+            print("Size:         %s (limit %s)" % (
+                _format_size(stats['size']),
+                _format_size(stats['max_bytes'])))
+            print("Saved:        %s (deduplication and compression)" %
+                  _format_size(stats['logical_size'] - stats['size']))
+            print("Hits/misses:  %d/%d (%s)" % (
+                stats['hits'], stats['misses'],
+                "%.1f%%" % (100 * hit_rate) if hit_rate is not None
+                else "no lookups"))
+            print("Revalidated:  %d" % stats['revalidated'])
+            if stats['biggest']:
+                print("Largest entries:")
+            for entry in stats['biggest']:
+                print("  %10s  %s" %
+                      (_format_size(entry['stored_size']), entry['resid']))
+        else:
+            raise ValueError("Unknown action for subcommand")
+
+
+def _print_progress(done, total):
+    """ show the progress of a download on a single terminal line """
+    if total:
+        print("\r%s of %s (%d%%)" % (_format_size(done), _format_size(total),
+                                     100 * done // total),
+              end='', flush=True)
+    else:
+        print("\r%s" % _format_size(done), end='', flush=True)
+
+
+def _format_size(size):
+    """ format a number of bytes for humans """
+    if size is None:
+        return "none"
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return "%.1f %s" % (size, unit) if unit != 'B' else "%d B" % size
+        size /= 1024
+    return "%.1f TiB" % size
@@ -23,6 +23,11 @@ def auto_start(config):
     call = config.login_callable()
     moodle = call()
     moodle.cache = config.cache_location
+    moodle.cache_max_bytes = config.cache_max_bytes
+    moodle.cache_max_entries = config.cache_max_entries
+    moodle.cache_compression = config.cache_compression
+    if config.cache_memory_bytes is not None:
+        moodle.memory_cache.max_bytes = config.cache_memory_bytes
     course = moodle.course(config.course)
     return moodle, course
 
@@ -152,6 +157,26 @@ class MtConfig:
     def cache_location(self):
         return self.data['cache']['location']
 
+    @property
+    def cache_max_bytes(self):
+        return self.data['cache'].get('max_bytes')
+
+    @property
+    def cache_max_entries(self):
+        return self.data['cache'].get('max_entries')
+
+    @property
+    def cache_compression(self):
+        return self.data['cache'].get('compression')
+
+    @property
+    def cache_memory_bytes(self):
+        return self.data['cache'].get('memory_bytes')
+
+    @property
+    def assignment_perpage(self):
+        return self.data.get('assignment', {}).get('perpage')
+
     @property
     def course(self):
         return self.data['course']['id']
@@ -5,11 +5,13 @@
 # Copyright (c) 2015-2018 Stuart Prescott
 
 import collections
+import hashlib
 import io
 import logging
 import os
 import os.path
 import re
+import threading
 import time
 
 import bs4
@@ -17,7 +19,7 @@ import numpy
 import pandas
 
 from moodletools import resources
-from moodletools.utils import resid_factory
+from moodletools.utils import file_digest, parallel_map, resid_factory
 
 
 logger = logging.getLogger(__name__)
@@ -46,6 +48,8 @@ class Course:
         self.id = course_id
         self.moodle = moodle
 
+        self._inventory = None
+
         self.status_missing = "MISSING"
         self.status_submitted = "submitted"
         self.status_marked = "marked"
@@ -114,24 +118,34 @@ class Course:
         """
         return resources.Resource(resource_id, self)
 
+    def folder(self, folder_id):
+        """ create a Folder object within this course
+
+        folder_id: str or int
+            the id of the folder activity
+        """
+        return resources.Folder(folder_id, self)
+
     def gradebook(self):
         """ create the Greadebook object within this course """
         return Gradebook(self)
 
     _course_page_url = "course/view.php?id=%s"
 
-    def get_course_page(self, resid='auto'):
+    def get_course_page(self, resid='auto', force=False):
         """ return a requests.Response object for the course page
 
         :param resid: the resource id for caching the download. Note that
             since the login session key is extracted from this page,
             pulling from the cache is automatically disabled if the
             session key is not yet set.
+        :param force: bool, optional, default `False`.
+            Forces redownload of the resource.
 
         :returns: a requests response object with the data
         """
         resid = resid_factory(self, "course-page-{id}", resid)
-        force = not self.moodle.has_sesskey
+        force = force or not self.moodle.has_sesskey
 
         page = self.moodle.fetch(
             self._course_page_url % self.id,
@@ -141,6 +155,32 @@ class Course:
         self.moodle.set_sesskey(page)
         return page
 
+    _section_page_url = "course/view.php?id=%s&section=%s"
+
+    def get_section_page(self, section, resid='auto', force=False):
+        """ return a requests.Response object for a section of the course
+
+        Moodle can display a single section of the course, which for large
+        courses is much smaller than the whole course page. Note that
+        section 0 cannot be requested alone; Moodle shows the whole course
+        page instead.
+
+        :param section: int, the section number
+        :param resid: the resource id for caching the download
+        :param force: bool, optional, default `False`.
+            Forces redownload of the resource.
+
+        :returns: a requests response object with the data
+        """
+        resid = resid_factory(
+            self, "course-section-{id}-%d" % int(section), resid)
+
+        return self.moodle.fetch(
+            self._section_page_url % (self.id, int(section)),
+            resid=resid,
+            force=force,
+        )
+
     _log_form_url = (
         "report/log/index.php?"
         "chooselog=1&"
@@ -154,6 +194,8 @@ class Course:
         "edulevel=-1&"
         "logreader=logstore_standard")
 
+    _log_form_template = "report-log-%s"
+
     _log_export_url = (
         "report/log/index.php?"
         "id=%s&"         # course id
@@ -179,7 +221,8 @@ class Course:
             self._log_export_url % (self.id, activity_id),
             _clean,
             resid_factory(self, "course-logs-{id}", resid),
-            form_name=None
+            form_name=None,
+            template=self._log_form_template % self.id,
         )
 
     _completion_summary_url = 'report/progress/index.php?course=%d&format=csv'
@@ -204,53 +247,220 @@ class Course:
             }),
             None)
 
-    def quick_action_all(self, types, action):
+    # visibility of an activity once the quick action has been applied
+    _quick_action_visible = {
+        'hide': False,
+        'show': True,
+    }
+
+    def _quick_action_targets(self, types, action):
+        """ list the resources for which the quick action would do something
+
+        returns: list of CourseResource
+        """
+        visible = self._quick_action_visible.get(action)
+
+        if visible is None:
+            return self.list_all(types)
+
+        # the state of the activities must be current to skip any
+        candidates = self.list_all(types, force=True)
+        acts = [a for a in candidates if a.visible != visible]
+        logger.info("Skipping %d of %d activities already in the "
+                    "requested state (requests saved)",
+                    len(candidates) - len(acts), len(candidates))
+        return acts
+
+    def quick_action_all(self, types, action, jobs=1):
         """ run an action for all resources of a certain type
 
         Iterate through the course page, running a specified 'quick link'
         (such as "hide" or "show") for every resource on the course page
         that is in the given list of resource types.
 
+        For actions that change the visibility of the activity, the
+        current state of the activity is read from a freshly downloaded
+        course page and activities that are already in the desired state
+        are skipped.
+
         types: list, set, tuple
             list of str of the types to be changed. Known types include
             'resource', 'page', 'forum' etc; check the URL for a resource
             for its name.
         action: str
             the action name as specified in the quick link
+        jobs: int, optional, default 1
+            number of requests to send to the server in parallel
 
         returns: list of CourseResource
-            the entries that were processed
+            the entries that were successfully processed; failures are
+            logged and omitted from the list
         """
-        acts = self.list_all(types)
+        acts = self._quick_action_targets(types, action)
 
-        for a in acts:
-            self.quick_action(a.id, action)
+        # harvest the sesskey once before any parallel requests are made
+        self.moodle.sesskey()
 
-        return acts
+        def _action(act):
+            self.quick_action(act.id, action)
+
+        done = []
+        for task in parallel_map(_action, acts, jobs):
+            if task.error is not None:
+                logger.error("Action '%s' failed for activity %s: %s",
+                             action, task.item.id, task.error)
+            else:
+                done.append(task.item)
 
-    def hide_all(self, types=None):
+        if done:
+            # the cached course page no longer reflects the course
+            self.moodle.invalidate(resid_factory(self, "course-page-{id}"))
+
+        return done
+
+    def hide_all(self, types=None, jobs=1):
         """ hide all resources of a certain type on the course page
 
         types: list of str, optional
             list of Moodle resource type names that are to be hidden
+        jobs: int, optional, default 1
+            number of requests to send to the server in parallel
 
         returns: list of CourseResource
             list of resource that were hidden
         """
-        return self.quick_action_all(types, 'hide')
+        return self.quick_action_all(types, 'hide', jobs)
 
-    def unhide_all(self, types=None):
+    def unhide_all(self, types=None, jobs=1):
         """ unhide all resources of a certain type on the course page
 
         types: list of str, optional
             list of Moodle resource type names that are to be unhidden
+        jobs: int, optional, default 1
+            number of requests to send to the server in parallel
 
         returns: list of CourseResource
             list of resource that were unhidden
         """
-        return self.quick_action_all(types, 'show')
+        return self.quick_action_all(types, 'show', jobs)
+
+    _inventory_key = "course-inventory-{id}"
+
+    def inventory(self, force=False):
+        """ return the inventory of the activities on the course page
+
+        The activities extracted from the course page are kept, along with
+        the hash of the page, both in memory and in the on-disk cache. The
+        activities are only extracted from the page again when the content
+        of the course page changes.
+
+        force: bool, optional, default `False`
+            forces redownload of the course page
+
+        returns: ActivityInventory
+        """
+        page = self.get_course_page(force=force)
+        digest = getattr(page, 'content_hash', None) or \
+            hashlib.sha256(page.content).hexdigest()
+
+        if self._inventory is not None and \
+                self._inventory.page_hash == digest:
+            return self._inventory
+
+        key = self._inventory_key.format(id=self.id)
+        stored = ActivityInventory.from_dict(self.moodle.load_value(key))
+
+        if stored is not None and stored.page_hash == digest:
+            logger.debug("Using stored activity inventory")
+            self._inventory = stored
+            return stored
+
+        soup = self.moodle.parse(page, parse_only=_course_content_strainer)
+        self._inventory = ActivityInventory(
+            _course_activities(soup), digest)
+        self.moodle.save_value(key, self._inventory.to_dict())
+        return self._inventory
+
+    def list_section(self, section, types=None, force=False):
+        """ list the resources within one section of the course
+
+        Only the page for that section is downloaded and parsed.
+
+        section: int
+            the section number
+        types: list of str, optional
+            list of resources to include; if not specified or None, all
+            resources are listed.
+        force: bool, optional, default `False`
+            forces redownload of the section page
+
+        returns: list of CourseResource
+        """
+        page = self.get_section_page(section, force=force)
+        return self._section_activities(page, section, types) or []
+
+    def _section_activities(self, page, section, types=None):
+        """ extract the activities of a section from a page, if present """
+        soup = self.moodle.parse(page, parse_only=_course_content_strainer)
+        element = soup.find('li', id='section-%d' % int(section))
+        if element is None:
+            logger.debug("Section %s not found in page", section)
+            return None
+        return _activities_within(element, types, int(section))
+
+    _section_link_re = r'course/view\.php\?id=%s&(?:amp;)?section=(\d+)'
+
+    def _discover_sections(self, first, types):
+        """ find the section numbers from the page for section 1
+
+        returns: list of int, dict
+            the section numbers in order, and the resources of the sections
+            that are already contained in the page, keyed by number
+        """
+        link_re = re.compile(self._section_link_re % self.id)
+        numbers = set(int(n) for n in link_re.findall(first.text))
+        numbers.add(1)
+
+        found = {}
+        for n in (0, 1):
+            acts = self._section_activities(first, n, types)
+            if acts is not None:
+                found[n] = acts
+        numbers.discard(0)
+        numbers.update(found)
+        return sorted(numbers), found
+
+    def sections(self, types=None, jobs=4):
+        """ iterate over the sections of the course, one page per section
+
+        The section numbers are discovered from the section navigation
+        within the page for section 1; the pages for the remaining sections
+        are then fetched concurrently. Section 0 is included if it is shown
+        on the page for section 1.
+
+        types: list of str, optional
+            list of resources to include; if not specified or None, all
+            resources are listed.
+        jobs: int, optional, default 4
+            number of section pages to download in parallel
+
+        returns: generator of (int, list of CourseResource)
+            the section number and the resources in it, in section order
+        """
+        first = self.get_section_page(1)
+        numbers, found = self._discover_sections(first, types)
+
+        def _list(section):
+            if section in found:
+                return found[section]
+            return self.list_section(section, types)
 
-    def list_all(self, types=None):
+        for task in parallel_map(_list, numbers, jobs):
+            if task.error is not None:
+                raise task.error
+            yield task.item, task.result or []
+
+    def list_all(self, types=None, force=False):
         """ list all resources that are shown on the course page
 
         The list of resources can be filtered down to those matching the
@@ -261,51 +471,160 @@ class Course:
         types: list of str, optional
             list of resources to include; if not specified or None, all
             resources are listed.
+        force: bool, optional, default `False`
+            forces redownload of the course page
 
         returns: list of CourseResource
             each resource is placed in the list as a CourseResource object
         """
+        return self.inventory(force).filter(types)
 
-        # find all the A anchors in the content part of the course page
-        # (excluding menus, side bars, theme etc); only links to resources
-        # are wanted, which are of form /mod/{resource name}/...id=XYZ
-        activity_link_re = re.compile(r'mod/([^/]+).*id=(\d+)')
+    def assignments_status(self, jobs=4, force=False, perpage=None):
+        """ fetch the submission status of all assignments in the course
 
-        page = self.get_course_page()
-        bs = bs4.BeautifulSoup(page.text, 'lxml')
+        The Assignment activities are found on the course page and their
+        grading tables are fetched concurrently; the status and grade of
+        each student in each assignment are returned in long format.
+        Assignments whose grading table cannot be fetched are logged and
+        omitted.
 
-        div = bs.find('div', class_='course-content')
-        containers = div.find_all('li', class_='activity')
-        activities = []
+        jobs: int, optional, default 4
+            number of assignments to fetch in parallel
+        force: bool, optional, default `False`
+            forces redownload of the course page and grading tables
+        perpage: int or 'all', optional
+            number of rows per page when fetching the grading tables
 
-        for activity in containers:
-            _, act_id = activity['id'].split('-')
-            act_type = activity['class'][1]
-            name = activity.find('span', class_="instancename")
-            if name:
-                text = name.text
+        returns: pandas.DataFrame
+            with columns 'Assignment' (the activity id), 'Username',
+            'Status' and 'Grade'
+        """
+        columns = ['Assignment', 'Username', 'Status', 'Grade']
+        acts = self.list_all(types=['assign'], force=force)
+
+        def _status(act):
+            assgt = self.assignment(act.id)
+            # the assignments are already fetched in parallel
+            assgt._fetch_status_data(force, jobs=1, perpage=perpage)
+            df = assgt.get_submission_status()
+            df['Grade'] = assgt.get_grades()['Grade']
+            df['Assignment'] = act.id
+            return df.reset_index()[columns]
+
+        frames = []
+        for task in parallel_map(_status, acts, jobs):
+            if task.error is not None:
+                logger.error("Unable to fetch status for assignment %s: %s",
+                             task.item.id, task.error)
             else:
-                name = activity.find('div', class_="contentwithoutlink")
-                if name:
-                    text = name.text
-                else:
-                    text = activity.text
-            url = activity.find('a', attrs={'href': activity_link_re})
-            href = None
-            if url:
-                href = url['href']
-
-            if types is None or act_type in types:
-                activities.append(
-                    CourseResource(
-                        href,
-                        int(act_id),
-                        act_type,
-                        text,
-                    )
-                )
-
-        return activities
+                frames.append(task.result)
+
+        if not frames:
+            return pandas.DataFrame(columns=columns)
+
+        df = pandas.concat(frames, ignore_index=True)
+        df['Status'] = df['Status'].astype('category')
+        return df
+
+    _download_types = {
+        'resource': 'resource',
+        'folder': 'folder',
+    }
+
+    # Moodle uses the SHA1 hash of the file content as the ETag of files
+    _sha1_etag_re = re.compile(r'^"?([0-9a-f]{40})"?$')
+
+    def download_all(self, dest, types=None, jobs=4, progress=None):
+        """ download the files of all file resources on the course page
+
+        The resources are found on the course page and downloaded
+        concurrently into the `dest` directory, using the filenames given
+        by the server; folders are downloaded as zip files. Files that are
+        already present with the same size (and the same content, if the
+        server gives the SHA1 hash of the file as its ETag) are skipped.
+        If several activities have the same filename, the first on the
+        course page keeps it and the others are prefixed with their id.
+
+        dest: str
+            the directory into which the files are saved
+        types: list of str, optional, default ['resource', 'folder']
+            the types of activity to download
+        jobs: int, optional, default 4
+            number of files to download in parallel
+        progress: callable, optional
+            called as `progress(activity, filename, status)` as each
+            download finishes
+
+        returns: list of DownloadStatus
+            the outcome for each activity, in course page order
+        """
+        types = types or list(self._download_types)
+        unknown = set(types) - set(self._download_types)
+        if unknown:
+            raise ValueError("Unable to download activities of type: %s" %
+                             ", ".join(sorted(unknown)))
+
+        os.makedirs(dest, exist_ok=True)
+        acts = self.list_all(types=types)
+
+        claims = _FilenameClaims(dest)
+
+        def _download(item):
+            index, act = item
+            try:
+                return self._download_activity(
+                    act, lambda act, name: claims.claim(index, act, name))
+            finally:
+                claims.release(index)
+
+        results = []
+        for task in parallel_map(_download, enumerate(acts), jobs):
+            if task.error is not None:
+                _, act = task.item
+                logger.error("Download of activity %s failed: %s",
+                             act.id, task.error)
+                status = DownloadStatus(act, None, 'failed', None,
+                                        task.error)
+            else:
+                status = task.result
+            if progress:
+                progress(status.activity, status.filename, status.status)
+            results.append(status)
+        return results
+
+    def _download_activity(self, act, claim):
+        """ download the file for one activity unless it is up to date
+
+        act: CourseResource
+            the activity to download
+        claim: callable
+            returns the local path for the activity given the activity and
+            the server filename
+        """
+        factory = getattr(self, self._download_types[act.type])
+        res = factory(act.id)
+        response = res._get_file_helper(stream=True)
+        response.raise_for_status()
+
+        filename = claim(act,
+                         resources._negotiate_filename(response, None, False))
+
+        length = response.headers.get('Content-Length')
+        match = self._sha1_etag_re.match(response.headers.get('ETag', ''))
+
+        if os.path.exists(filename) and length and \
+                os.path.getsize(filename) == int(length) and \
+                (match is None or file_digest(filename) == match.group(1)):
+            logger.debug("Skipping %s; already up to date", filename)
+            response.close()
+            return DownloadStatus(act, filename, 'skipped', int(length), None)
+
+        digest = hashlib.sha1()
+        size = self.moodle.download(response, filename, digest=digest)
+        if match and digest.hexdigest() != match.group(1):
+            logger.warning("Content of %s does not match the server's hash",
+                           filename)
+        return DownloadStatus(act, filename, 'downloaded', size, None)
 
     def apply_release_dates(self, data, act=True):
         """
@@ -324,6 +643,7 @@ class Gradebook:
 
     _gradebook_form_url = "grade/export/xls/index.php?id=%s"
     _gradebook_export_url = 'grade/export/xls/export.php'
+    _gradebook_form_template = "grade-export-xls-%s"
 
     def __init__(self, course):
         self.course = course
@@ -357,6 +677,7 @@ class Gradebook:
             _clean,
             resid_factory(self.course, "course-gradebook-{id}", self.resid),
             force=force,
+            template=self._gradebook_form_template % self.course.id,
         )
 
     def as_dataframe(self, fillna=True, force=False):
@@ -413,10 +734,231 @@ CourseResource = collections.namedtuple(
         'id',
         'type',
         'name',
+        'visible',
+        'restricted',
+        'section',
+    ]
+)
+CourseResource.__new__.__defaults__ = (True, False, None)
+
+
+class _FilenameClaims:
+    """ Local filenames for concurrent downloads, allocated in course order
+
+    Each download claims its filename once the server has given it, but
+    only after all of the activities before it on the course page have
+    claimed theirs (or failed), so that the activity that is given the
+    unprefixed name of a duplicated filename does not depend on which
+    download happens to be quickest.
+
+    The downloads must be started in course order, as with `parallel_map`,
+    so that the earlier activities are always in progress.
+
+    :param dest: str, the directory into which the files are saved
+    :param claimed: iterable of str, optional, filenames that are already
+        in use and must not be given out
+    """
+    def __init__(self, dest, claimed=None):
+        self.dest = dest
+        self._claimed = set(claimed or [])
+        self._next = 0
+        self._condition = threading.Condition()
+
+    def claim(self, index, act, name):
+        """ return the local path for the activity at `index` """
+        base = os.path.basename(name)
+        with self._condition:
+            self._condition.wait_for(lambda: self._next == index)
+            name = base
+            count = 1
+            while name in self._claimed:
+                name = "%s-%s" % (act.id, base) if count == 1 \
+                    else "%s-%d-%s" % (act.id, count, base)
+                count += 1
+            self._claimed.add(name)
+            self._next += 1
+            self._condition.notify_all()
+        return os.path.join(self.dest, name)
+
+    def release(self, index):
+        """ let later activities proceed if `index` made no claim """
+        with self._condition:
+            if self._next > index:
+                return
+            self._condition.wait_for(lambda: self._next == index)
+            self._next += 1
+            self._condition.notify_all()
+
+
+DownloadStatus = collections.namedtuple(
+    'DownloadStatus',
+    [
+        'activity',
+        'filename',
+        'status',
+        'size',
+        'error',
     ]
 )
 
 
+class ActivityInventory:
+    """ Indexed collection of the activities on a course page
+
+    :param activities: list of CourseResource, in course page order
+    :param page_hash: str, optional, hash of the course page from which
+        the activities were extracted
+    """
+    _format_version = 2
+
+    def __init__(self, activities, page_hash=None):
+        self.activities = list(activities)
+        self.page_hash = page_hash
+
+        self._by_id = {}
+        self._by_type = collections.defaultdict(list)
+        self._by_name = collections.defaultdict(list)
+        for act in self.activities:
+            self._by_id[act.id] = act
+            self._by_type[act.type].append(act)
+            self._by_name[act.name].append(act)
+
+    def __len__(self):
+        return len(self.activities)
+
+    def __iter__(self):
+        return iter(self.activities)
+
+    def by_id(self, activity_id):
+        """ return the CourseResource with the id or `None` """
+        return self._by_id.get(int(activity_id))
+
+    def by_type(self, activity_type):
+        """ return the list of CourseResource of a type """
+        return list(self._by_type.get(activity_type, []))
+
+    def by_name(self, name):
+        """ return the list of CourseResource with the name """
+        return list(self._by_name.get(name, []))
+
+    def filter(self, types=None):
+        """ return the list of CourseResource with any of the types
+
+        types: list of str, optional
+            list of resources to include; if not specified or None, all
+            resources are listed.
+        """
+        if types is None:
+            return list(self.activities)
+        if len(types) == 1:
+            return self.by_type(list(types)[0])
+        types = set(types)
+        return [a for a in self.activities if a.type in types]
+
+    def to_dict(self):
+        """ serialise the inventory for storage """
+        return {
+            'version': self._format_version,
+            'page_hash': self.page_hash,
+            'activities': [a._asdict() for a in self.activities],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ recreate a stored inventory, `None` if not possible """
+        if not data or data.get('version') != cls._format_version:
+            return None
+        return cls(
+            [CourseResource(**a) for a in data['activities']],
+            data['page_hash'],
+        )
+
+
+# only the content part of the course page is wanted (excluding menus,
+# side bars, theme etc)
+_course_content_strainer = bs4.SoupStrainer('div', class_='course-content')
+
+# only links to resources are wanted, which are of form
+# /mod/{resource name}/...id=XYZ
+_activity_link_re = re.compile(r'mod/([^/]+).*id=(\d+)')
+
+
+def _course_activities(soup, types=None):
+    """ extract the activities from the parsed course page """
+    div = soup.find('div', class_='course-content')
+    if div is None:
+        logger.warning("No course content found in course page")
+        return []
+    return _activities_within(div, types)
+
+
+def _activities_within(element, types=None, section=None):
+    """ extract the activities from the li.activity rows of an element
+
+    If the element is the course content rather than a single section, the
+    section of each activity is taken from the li.section that holds it.
+    """
+    if section is None:
+        sections = element.find_all('li', class_='section')
+        if sections:
+            activities = []
+            for s in sections:
+                _, _, number = s.get('id', '').partition('-')
+                number = int(number) if number.isdigit() else None
+                activities.extend(_activities_within(s, types, number))
+            return activities
+
+    activities = []
+
+    for activity in element.find_all('li', class_='activity'):
+        act_type = activity['class'][1]
+        if types is not None and act_type not in types:
+            continue
+
+        _, act_id = activity['id'].split('-')
+        name = activity.find('span', class_="instancename")
+        if name:
+            text = name.text
+        else:
+            name = activity.find('div', class_="contentwithoutlink")
+            if name:
+                text = name.text
+            else:
+                text = activity.text
+        url = activity.find('a', attrs={'href': _activity_link_re})
+        href = None
+        if url:
+            href = url['href']
+
+        # Moodle dims the link (or the text of a label) for hidden
+        # activities and adds an explanation of restricted access; visible
+        # activities that are restricted are also dimmed for teachers but
+        # are marked as conditionally hidden
+        visible = True
+        conditional = False
+        for dimmed in activity.find_all(class_=['dimmed', 'dimmed_text']):
+            if 'conditionalhidden' in dimmed.get('class', []):
+                conditional = True
+            else:
+                visible = False
+        restricted = conditional or activity.find(
+            'div', class_='availabilityinfo') is not None
+
+        activities.append(
+            CourseResource(
+                href,
+                int(act_id),
+                act_type,
+                text,
+                visible,
+                restricted,
+                section,
+            )
+        )
+
+    return activities
+
+
 def to_dataframe(data):
     """ create a pandas DataFrame of a list of CourseResource objects
 
@@ -0,0 +1,253 @@
+""" Incremental mirror of the files within a course
+
+The files of the resources and folders on the course page are kept in a
+local directory along with a manifest recording, for each activity, the
+URL that the file was downloaded from, its filename, size, ETag and hash.
+On each subsequent run the server is asked whether each file has changed
+using a conditional request, and only new or changed files are downloaded;
+activities that have been removed from the course page are reported.
+
+Example usage
+=============
+
+    >>> from moodletools.mirror import CourseMirror
+    >>> mirror = CourseMirror(mymoodle.course(12345), 'backup/12345')
+    >>> for status in mirror.sync():
+    ...     print(status.status, status.filename)
+"""
+
+# Copyright (c) 2018 Stuart Prescott
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from moodletools import resources
+from moodletools.course import (CourseResource, DownloadStatus,
+                                 _FilenameClaims)
+from moodletools.utils import parallel_map
+
+
+logger = logging.getLogger(__name__)
+
+
+class CourseMirror:
+    """ A local copy of the files within a course
+
+    :param course: moodletools.course.Course, the course to mirror
+    :param dest: str, the directory holding the copy of the files
+    """
+    manifest_name = '.moodletools-manifest.json'
+    _manifest_version = 1
+
+    def __init__(self, course, dest):
+        self.course = course
+        self.dest = dest
+        self.manifest_file = os.path.join(dest, self.manifest_name)
+
+    def load_manifest(self):
+        """ return the manifest entries keyed by activity id """
+        try:
+            with open(self.manifest_file) as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring unreadable manifest %s",
+                           self.manifest_file)
+            return {}
+
+        if data.get('version') != self._manifest_version:
+            return {}
+        return {str(e['id']): e for e in data['files']}
+
+    def save_manifest(self, entries):
+        """ write the manifest, replacing the old one only once complete """
+        data = {
+            'version': self._manifest_version,
+            'course': self.course.id,
+            'files': sorted(entries.values(), key=lambda e: str(e['id'])),
+        }
+        fd, tmpname = tempfile.mkstemp(dir=self.dest, prefix='.manifest')
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(data, fh, indent=1)
+        os.replace(tmpname, self.manifest_file)
+
+    @staticmethod
+    def _conditional_headers(entry):
+        """ request headers asking for the file only if it has changed """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _sync_activity(self, act, entry, claim):
+        """ bring the local copy of one activity up to date
+
+        act: CourseResource
+            the activity to bring up to date
+        entry: dict
+            the manifest entry for the activity, `None` if it is new
+        claim: callable
+            returns the local path for a new file given the activity and
+            the server filename
+
+        returns: DownloadStatus, dict
+            the outcome and the new manifest entry for the activity
+        """
+        moodle = self.course.moodle
+        local = entry and os.path.join(self.dest, entry['filename'])
+        exists = local is not None and os.path.exists(local)
+
+        response = None
+        if exists and entry.get('url'):
+            headers = self._conditional_headers(entry)
+            response = moodle.fetch(entry['url'], stream=True,
+                                    headers=headers)
+            if response.status_code == 304:
+                response.close()
+                entry = dict(entry, last_seen=time.time(), name=act.name)
+                return (DownloadStatus(act, local, 'unchanged',
+                                       entry['size'], None), entry)
+            if response.status_code >= 400:
+                # the file has moved; find it again from the activity
+                response.close()
+                response = None
+
+        if response is None:
+            factory = getattr(self.course,
+                              self.course._download_types[act.type])
+            response = factory(act.id)._get_file_helper(stream=True)
+            response.raise_for_status()
+
+        server_name = resources._negotiate_filename(response, None, False)
+        if entry and entry.get('server_filename') == server_name:
+            filename = entry['filename']
+        else:
+            filename = os.path.basename(claim(act, server_name))
+        path = os.path.join(self.dest, filename)
+
+        etag = response.headers.get('ETag')
+        length = response.headers.get('Content-Length')
+        if exists and filename == entry['filename'] and etag and \
+                etag == entry.get('etag') and length and \
+                int(length) == os.path.getsize(path):
+            response.close()
+            entry = dict(entry, url=response.url, last_seen=time.time(),
+                         name=act.name)
+            return (DownloadStatus(act, path, 'unchanged', entry['size'],
+                                   None), entry)
+
+        digest = hashlib.sha1()
+        size = moodle.download(response, path, digest=digest)
+
+        if not entry:
+            status = 'new'
+        elif exists and entry.get('sha1') == digest.hexdigest():
+            # for example, folders are zipped afresh on each request
+            status = 'unchanged'
+        else:
+            status = 'changed'
+
+        if entry and entry['filename'] != filename:
+            logger.info("File for activity %s renamed from %s to %s",
+                        act.id, entry['filename'], filename)
+
+        entry = {
+            'id': act.id,
+            'type': act.type,
+            'name': act.name,
+            'url': response.url,
+            'server_filename': server_name,
+            'filename': filename,
+            'size': size,
+            'etag': etag,
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha1': digest.hexdigest(),
+            'last_seen': time.time(),
+        }
+        return DownloadStatus(act, path, status, size, None), entry
+
+    def sync(self, types=None, jobs=4, progress=None):
+        """ download the files that are new or have changed on the server
+
+        types: list of str, optional, default ['resource', 'folder']
+            the types of activity to mirror
+        jobs: int, optional, default 4
+            number of files to check or download in parallel
+        progress: callable, optional
+            called as `progress(activity, filename, status)` as each
+            activity is processed
+
+        returns: list of DownloadStatus
+            the outcome for each activity, one of 'new', 'changed',
+            'unchanged', 'failed' or 'deleted'; files for activities that
+            have been deleted from the course are not removed locally.
+        """
+        types = types or list(self.course._download_types)
+        os.makedirs(self.dest, exist_ok=True)
+
+        entries = self.load_manifest()
+        acts = self.course.list_all(types=types, force=True)
+        current = {str(a.id) for a in acts}
+
+        # new files must not replace those of other activities, including
+        # deleted ones, or files in the directory that are not tracked
+        claims = _FilenameClaims(
+            self.dest,
+            {e['filename'] for e in entries.values()} |
+            set(os.listdir(self.dest)),
+        )
+
+        def _sync(item):
+            index, act = item
+            try:
+                return self._sync_activity(
+                    act, entries.get(str(act.id)),
+                    lambda act, name: claims.claim(index, act, name))
+            finally:
+                claims.release(index)
+
+        results = []
+        try:
+            for task in parallel_map(_sync, enumerate(acts), jobs):
+                _, act = task.item
+                if task.error is not None:
+                    logger.error("Sync of activity %s failed: %s",
+                                 act.id, task.error)
+                    status = DownloadStatus(act, None, 'failed', None,
+                                            task.error)
+                else:
+                    status, entry = task.result
+                    entries[str(act.id)] = entry
+                if progress:
+                    progress(status.activity, status.filename, status.status)
+                results.append(status)
+
+            removed = [
+                key for key, e in entries.items()
+                if key not in current and e['type'] in types
+            ]
+            for key in sorted(removed):
+                entry = entries.pop(key)
+                logger.info("Activity %s (%s) no longer in course",
+                            key, entry['name'])
+                status = DownloadStatus(
+                    CourseResource(None, entry['id'], entry['type'],
+                                   entry['name']),
+                    os.path.join(self.dest, entry['filename']),
+                    'deleted', entry['size'], None,
+                )
+                if progress:
+                    progress(status.activity, status.filename, status.status)
+                results.append(status)
+        finally:
+            self.save_manifest(entries)
+
+        return results
@@ -31,11 +31,12 @@ adds some labels to course with id 2 and then hides them all::
 
 import logging
 import re
-
-import bs4
+import time
 
 from moodletools.course import Course
-from moodletools.utils import (Cacher, CacheMissError, resid_factory)
+from moodletools.utils import (Cacher, CacheMissError, CacheStaleError,
+                               CacheStore, MemoryCache, PartialDownload,
+                               SoupCache, resid_factory, stream_to_file)
 
 
 logger = logging.getLogger(__name__)
@@ -75,7 +76,14 @@ class Moodle:
         self._sesskey = None
         self.cache_max_age = 1800
         self.cache = 'cache'
+        self.cache_max_bytes = None
+        self.cache_max_entries = None
+        self.memory_cache = MemoryCache()
+        self.soup_cache = SoupCache()
+        self.cache_compression = None
         self.payload = True
+        self.form_template_max_age = 1800
+        self._form_templates = {}
 
     def sesskey(self):
         """ return the sesskey for the session """
@@ -87,12 +95,31 @@ class Moodle:
     def has_sesskey(self):
         return self._sesskey is not None
 
+    # the sesskey is in the M.cfg javascript configuration in the page
+    # header, in hidden form inputs and in the URLs of action links
+    _sesskey_re = re.compile(
+        rb'"sesskey"\s*:\s*"([^"]+)"|'
+        rb'<input[^>]+name="sesskey"[^>]+value="([^"]+)"|'
+        rb'<input[^>]+value="([^"]+)"[^>]+name="sesskey"|'
+        rb'href="https?://[^"]*[?&](?:amp;)?sesskey=([^&"]+)'
+    )
+
     def set_sesskey(self, page):
-        """ opportunistically harvest the sesskey from the page """
+        """ opportunistically harvest the sesskey from the page
+
+        The raw bytes of the page are scanned for the sesskey, stopping at
+        the first match; only if that fails is the page parsed.
+        """
         if self._sesskey:
             return
 
-        bs = bs4.BeautifulSoup(page.text, 'lxml')
+        match = self._sesskey_re.search(page.content)
+        if match:
+            value = next(g for g in match.groups() if g is not None)
+            self._sesskey = value.decode('ascii', 'replace')
+            return
+
+        bs = self.parse(page)
 
         explicit = bs.find('input', {'name': 'sesskey'})
         if explicit:
@@ -106,6 +133,25 @@ class Moodle:
             self._sesskey = match.group(1)
             return
 
+    def parse(self, page, parser='lxml', parse_only=None, cache=True):
+        """ return the parsed HTML document for a response
+
+        Parsed documents are cached so that a page that is used in several
+        places is parsed only once; the returned document must not be
+        modified.
+
+        page: requests.Response
+            the response containing the HTML
+        parser: str, optional, default 'lxml'
+            the parser for BeautifulSoup to use
+        parse_only: bs4.SoupStrainer, optional
+            restrict the parsing to parts of the page
+        cache: bool, optional, default True
+            keep the parsed document for later callers; pages that are
+            only read once can be released as soon as they are finished with
+        """
+        return self.soup_cache.parse(page.text, parser, parse_only, cache)
+
     _dashboard_page_url = "my/"
 
     def get_dashboard_page(self, resid='auto'):
@@ -148,14 +194,115 @@ class Moodle:
         # base_url already ends with / so simply concatenate
         return self.base_url + path
 
+    def fetch_form(self, form_path, form_name='mform1', submitted=False):
+        """ return the response and field values of a form on the server
+
+        form_path: str
+            absolute HTTP path of the form on the server
+        form_name: str, optional
+            the form 'name' (or 'id') tag to find the correct form within the
+            HTML
+        submitted: bool, optional, default False
+            return the values that a browser would submit for the form as it
+            stands, so that it can be saved without changing any settings:
+            only checked checkboxes and radio buttons, the selected options
+            of select elements and empty fields are included.
+
+        returns: requests.Response, dict
+            the response containing the form and the dict of the values
+            within the form
+        """
+        form_url = self.url(form_path)
+
+        logger.debug("Fetching resource form: %s", form_url)
+        response_form = self.session.get(form_url)
+
+        logger.debug("Fetching resource form returned: %d",
+                     response_form.status_code)
+
+        if response_form.status_code == 404:
+            raise ValueError("Resource form not found")
+
+        self.set_sesskey(response_form)
+
+        # find all of the fields in the form to send back
+        soup = self.parse(response_form, "html.parser")
+        if form_name is not None:
+            form = soup.find(id=form_name)
+        else:
+            form = soup.find("form")
+
+        if submitted:
+            return response_form, _submitted_values(form)
+
+        payload = {}
+
+        inputs = form.find_all('input')
+        for i in inputs:
+            n = i.get('name')
+            v = i.get('value')
+            if v is not None and v != '':
+                payload[n] = v
+
+        textareas = form.find_all('textarea')
+        for t in textareas:
+            n = t.get('name')
+            v = t.contents
+            payload[n] = v[0] if v else ""
+
+        return response_form, payload
+
+    def _form_payload(self, form_path, form_name, template):
+        """ return the form field values, from the template cache if possible
+
+        The sesskey is never taken from the template but is always
+        replaced with the current sesskey of the session.
+        """
+        if template is not None:
+            cached = self._form_templates.get(template)
+            if cached and time.time() < cached[0] + self.form_template_max_age:
+                logger.debug("Using cached form template: %s", template)
+                payload = dict(cached[1])
+                if 'sesskey' in payload:
+                    payload['sesskey'] = self.sesskey()
+                return payload
+
+        _, payload = self.fetch_form(form_path, form_name)
+
+        if template is not None:
+            self._form_templates[template] = (time.time(), dict(payload))
+
+        return payload
+
+    def invalidate_form_template(self, template=None):
+        """ discard a cached form template
+
+        template: str, optional
+            the key of the template to discard; if `None`, all templates
+            are discarded.
+        """
+        if template is None:
+            self._form_templates.clear()
+        else:
+            self._form_templates.pop(template, None)
+
     def fetch_from_form(self, form_path, resource_path,
                         payload_filter, resid=None, force=False, files=None,
-                        form_name='mform1'):
+                        form_name='mform1', template=None):
         """ return a requests.Response object for a form submission
 
         The form is prefetched to get extra magic input keys out of the
         provided form data before submitting it back to the Moodle instance.
 
+        If a `template` key is given, the field values of the form are
+        remembered and the prefetch is skipped for subsequent submissions
+        using the same key. Templates must only be used for forms whose
+        fields do not depend on the item being edited, or where the
+        `payload_filter` sets all of the item-specific fields. A template
+        is discarded (and the form fetched afresh) when it is older than
+        `form_template_max_age`, when the submission fails with an HTTP
+        error or when :meth:`invalidate_form_template` is called.
+
         form_path: str
             absolute HTTP path of the form on the server
         resource_path: str
@@ -174,6 +321,9 @@ class Moodle:
         form_name: str, optional
             the form 'name' (or 'id') tag to find the correct form within the
             HTML
+        template: str, optional
+            key under which the form fields are cached for reuse (default,
+            None, always fetches the form)
         """
         cache = self.cache_factory(resid, force)
         try:
@@ -181,40 +331,9 @@ class Moodle:
 
         except CacheMissError:
 
-            form_url = self.url(form_path)
             resource_url = self.url(resource_path)
 
-            logger.debug("Fetching resource form: %s", form_url)
-            response_form = self.session.get(form_url)
-
-            logger.debug("Fetching resource form returned: %d",
-                         response_form.status_code)
-
-            if response_form.status_code == 404:
-                raise ValueError("Resource form not found")
-
-            # find all of the fields in the form to send back
-            soup = bs4.BeautifulSoup(response_form.text, "html.parser")
-            if form_name is not None:
-                form = soup.find(id=form_name)
-            else:
-                form = soup.find("form")
-
-            payload = {}
-
-            inputs = form.find_all('input')
-            for i in inputs:
-                n = i.get('name')
-                v = i.get('value')
-                if v is not None and v != '':
-                    payload[n] = v
-
-            textareas = form.find_all('textarea')
-            for t in textareas:
-                n = t.get('name')
-                v = t.contents
-                payload[n] = v[0] if v else ""
-
+            payload = self._form_payload(form_path, form_name, template)
             payload = payload_filter(payload)
 
             logger.debug("Fetching resource: %s", resource_url)
@@ -224,13 +343,23 @@ class Moodle:
             logger.debug("Fetching resource returned: %d",
                          response_resource.status_code)
 
+            if template is not None and response_resource.status_code >= 400 \
+                    and template in self._form_templates:
+                # the form may have changed; retry once without the template
+                logger.debug("Discarding form template: %s", template)
+                self.invalidate_form_template(template)
+                return self.fetch_from_form(
+                    form_path, resource_path, payload_filter, resid,
+                    force, files, form_name)
+
             if response_resource.status_code == 404:
                 raise ValueError("Resource not found")
 
             cache.save(response_resource)
             return response_resource
 
-    def fetch(self, resource_path, resid=None, force=False):
+    def fetch(self, resource_path, resid=None, force=False, stream=False,
+              headers=None):
         """ return a requests.Response object for the requested URL
 
         resource_path: str
@@ -239,20 +368,195 @@ class Moodle:
             resource id for caching to disk (`None` disables caching)
         force: bool, optional
             if `True`, forces redownload of the resource, bypassing the cache.
+        stream: bool, optional
+            if `True`, the body of the response is not downloaded until it
+            is read (for example, with `utils.stream_to_file`); the cache
+            is not used for streamed responses.
+        headers: dict, optional
+            additional request headers for streamed responses
         """
+        if stream:
+            resource_url = self.url(resource_path)
+            logger.debug("Streaming resource url: %s", resource_url)
+            return self.session.get(resource_url, stream=True,
+                                    headers=headers)
+
         cache = self.cache_factory(resid, force)
+        headers = None
         try:
             return cache.load()
 
+        except CacheStaleError as stale:
+            # ask the server whether the cached copy is still current
+            headers = stale.validators
+
         except CacheMissError:
-            resource_url = self.url(resource_path)
-            logger.debug("Fetching resource url: %s", resource_url)
+            pass
+
+        resource_url = self.url(resource_path)
+        logger.debug("Fetching resource url: %s", resource_url)
+
+        response_resource = self.session.get(resource_url, headers=headers)
+
+        if headers and response_resource.status_code == 304:
+            logger.debug("Resource not modified: %s", resource_url)
+            try:
+                return cache.refresh(response_resource)
+            except CacheMissError:
+                # entry evicted in the meantime; fetch unconditionally
+                response_resource = self.session.get(resource_url)
+
+        cache.save(response_resource)
+        return response_resource
+
+    _content_range_re = re.compile(r'bytes (\d+)-')
+
+    def download(self, response, filename, progress=None, digest=None,
+                 resume=True):
+        """ save the body of a streamed response into a file
+
+        The file is downloaded into `filename.part` and moved into place
+        once complete. If an earlier download of the same version of the
+        file was interrupted, only the remainder of the file is requested
+        from the server with a Range request; the If-Range header ensures
+        that the whole file is sent instead if it has changed.
+
+        response: requests.Response
+            the response for the file, fetched with `stream=True`
+        filename: str
+            the file into which the content is saved
+        progress: callable, optional
+            called as `progress(done, total)` as the file is written
+        digest: hashlib hash object, optional
+            updated with the whole content of the file
+        resume: bool, optional, default True
+            resume an interrupted download if possible
+
+        returns: int, the size of the file
+
+        raises: requests.HTTPError if the server replies with an error; any
+            partially downloaded file is kept
+        """
+        response.raise_for_status()
+
+        partial = PartialDownload(filename)
+        offset = partial.offset(response) if resume else 0
+
+        if offset:
+            state = partial.load()
+            if offset == state.get('size'):
+                logger.info("Download of %s already complete", filename)
+                response.close()
+                if digest is not None:
+                    partial.hash_into(digest)
+                partial.complete()
+                return offset
+
+            logger.info("Resuming download of %s from byte %d",
+                        filename, offset)
+            response.close()
+            response = self.fetch(response.url, stream=True, headers={
+                'Range': 'bytes=%d-' % offset,
+                'If-Range': partial.validator(response),
+            })
+
+            match = self._content_range_re.match(
+                response.headers.get('Content-Range', ''))
+            if response.status_code == 200:
+                logger.info("Server sent the whole file; restarting download")
+                offset = 0
+            elif response.status_code != 206 or not match or \
+                    int(match.group(1)) != offset:
+                # keep the partial download for another attempt
+                response.close()
+                response.raise_for_status()
+                raise ValueError("Server sent an unexpected part of %s" %
+                                 filename)
+
+        if not offset:
+            partial.discard()
+            partial.begin(response)
+        elif digest is not None:
+            partial.hash_into(digest)
+
+        size = stream_to_file(response, partial.part, progress=progress,
+                              digest=digest, offset=offset)
+        partial.complete()
+        return size
+
+    def load_value(self, key):
+        """ return a value stored in the on-disk cache or `None`
+
+        key: str
+            the name of the value
+        """
+        if self.cache is None:
+            return None
+        return CacheStore.open(self.cache).get_value(key)
 
-            response_resource = self.session.get(resource_url)
-            cache.save(response_resource)
-            return response_resource
+    def save_value(self, key, value):
+        """ store a value derived from cached resources in the on-disk cache
+
+        key: str
+            the name of the value
+        value:
+            any JSON-serialisable data
+        """
+        if self.cache is None:
+            return
+        CacheStore.open(self.cache).set_value(key, value)
+
+    def invalidate(self, resid):
+        """ remove a resource from the cache
+
+        resid: str
+            resource id in the cache; `None` is ignored
+        """
+        self.cache_factory(resid, True).clear()
 
     def cache_factory(self, resid, force):
         return Cacher(resid, self.payload,
                       self.cache, self.cache_max_age,
-                      force)
+                      force, self.cache_max_bytes, self.cache_max_entries,
+                      self.memory_cache, self.cache_compression)
+
+
+def _submitted_values(form):
+    """ the values that a browser would submit for a form
+
+    Moodle's advanced checkboxes are a hidden field with the value 0
+    followed by a checkbox with the value 1 of the same name, so the
+    checkbox only replaces the hidden value if it is checked.
+
+    form: bs4.Tag, the form element
+    """
+    payload = {}
+
+    for field in form.find_all(['input', 'select', 'textarea']):
+        name = field.get('name')
+        if not name or field.has_attr('disabled'):
+            continue
+
+        if field.name == 'input':
+            kind = field.get('type', 'text').lower()
+            if kind in ('checkbox', 'radio'):
+                if field.has_attr('checked'):
+                    payload[name] = field.get('value', 'on')
+            elif kind not in ('file', 'reset', 'button', 'image'):
+                payload[name] = field.get('value', '')
+
+        elif field.name == 'select':
+            options = field.find_all('option')
+            chosen = [o for o in options if o.has_attr('selected')]
+            values = [o.get('value', o.text) for o in chosen]
+            if field.has_attr('multiple'):
+                payload[name] = values
+            elif values:
+                payload[name] = values[-1]
+            elif options:
+                payload[name] = options[0].get('value', options[0].text)
+
+        else:
+            payload[name] = field.text
+
+    return payload
@@ -7,13 +7,15 @@
 import io
 import json
 import logging
+import os
 import re
 
-import bs4
 import numpy
 import pandas
 import pandas.io.parsers
 
+from moodletools.utils import MultipartStream, parallel_map
+
 
 logger = logging.getLogger(__name__)
 
@@ -76,7 +78,7 @@ class AbstractResource:
             self._add_set_form_url,
             _clean,
         )
-        bsresp = bs4.BeautifulSoup(response.text, 'lxml')
+        bsresp = self.course.moodle.parse(response)
         links = bsresp.find_all("a", attrs={'href': re.compile('forceview')})
         if links:
             href = links[0]['href']
@@ -177,149 +179,347 @@ class Assignment(AbstractResource):
     _form_url = "mod/assign/view.php?id=%s&action=grading" \
                 "&thide=plugin1&tifirst&tilast"
     _status_url = "mod/assign/view.php"
+    _form_template = "assign-grading-options-%s"
     _next_page = 'Next'
 
+    # rows per page of the grading table that every Moodle site accepts
+    _fallback_perpage = 50
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.status = None
-        self._html_status_cache = "assignment-{id}-{page}"
-        self._status_cache = "assignment-{id}-{page}"
+        self.perpage = self._fallback_perpage
+        self._html_status_cache = "assignment-{id}-{perpage}-{page}"
+        self._status_cache = "assignment-{id}-{perpage}-{page}"
+
+    @staticmethod
+    def _perpage_value(perpage):
+        """ the form value for the number of rows per page
+
+        Moodle uses -1 to show all rows on a single page.
+        """
+        if perpage in ('all', 'All', -1, '-1'):
+            return "-1"
+        perpage = int(perpage)
+        if perpage <= 0:
+            raise ValueError("Page size must be positive or 'all'")
+        return str(perpage)
+
+    def _get_status_pages(self, force=False, jobs=4, perpage=None):
+        """ fetch the pages of assignment status information
+
+        The first page of the grading table is fetched via the grading
+        options form; the number of pages is then read from the paging bar
+        and the remaining pages are fetched concurrently. The rows of each
+        page (see `_status_rows`) are yielded as a list in page order.
 
-    def _get_status_dataframes(self, force=False):
-        """ fetch a page of assignment status information and clean it
+        If the server rejects the requested page size, the table is
+        fetched again with the default page size of 50 rows; if the server
+        limits the page size, the additional pages are fetched as normal.
 
         :param force: bool, optional, default False
             force the data to be fetched from the server rather than using
             cached data
+        :param jobs: int, optional, default 4
+            number of pages to download in parallel
+        :param perpage: int or 'all', optional, default `None`
+            number of rows per page of the grading table, or 'all' to get
+            all rows on one page if the site allows it; if `None`, the
+            `perpage` attribute is used.
         """
+        perpage = self._perpage_value(
+            self.perpage if perpage is None else perpage)
+
         def _clean(payload):
-            payload['perpage'] = "50"    # FIXME THIS IS ICKY
+            payload['perpage'] = perpage
             payload['filter'] = ""
             payload['workflowfilter'] = ""
             return payload
 
-        def _resid():
+        def _resid(pagenum):
             if self._html_status_cache:
                 return self._html_status_cache.format_map({
                     'id': self.id,
                     'page': pagenum,
+                    'perpage': perpage,
                 })
             return None
 
-        pagenum = 0
-
         response = self.course.moodle.fetch_from_form(
             self._form_url % self.id,
             self._status_url,
             _clean,
-            _resid(),
+            _resid(0),
             force=force,
+            template=self._form_template % self.id,
         )
 
-        # process the table on each page in turn
-        while True:
-            soup = bs4.BeautifulSoup(response.text, "html.parser")
-            region = soup.find(id='region-main')
-            table = region.find('table')
+        rows, nexturl, lastpage = None, None, None
+        if response.status_code < 400:
+            rows, nexturl, lastpage = self._parse_status_page(response)
+
+        fallback = self._perpage_value(self._fallback_perpage)
+        if rows is None and perpage != fallback:
+            logger.warning("Server rejected page size %s for the grading "
+                           "table; using %s", perpage, fallback)
+            self.course.moodle.invalidate(_resid(0))
+            yield from self._get_status_pages(force, jobs, fallback)
+            return
+
+        if rows is None:
+            raise ValueError("No grading table found for assignment")
+
+        if nexturl is not None and perpage == "-1":
+            logger.info("Server limited the page size of the grading table")
+
+        yield rows
+
+        if nexturl is None:
+            return
+
+        if lastpage is None:
+            # page count unknown; follow the "Next" links one at a time
+            pagenum = 0
+            while nexturl is not None:
+                pagenum += 1
+                response = self.course.moodle.fetch(
+                    nexturl, _resid(pagenum), force=force)
+                rows, nexturl, _ = self._parse_status_page(response)
+                yield rows or []
+            return
+
+        def _fetch(pagenum):
+            response = self.course.moodle.fetch(
+                self._page_re.sub(r'\g<1>%d' % pagenum, nexturl),
+                _resid(pagenum),
+                force=force,
+            )
+            rows, _, _ = self._parse_status_page(response)
+            return rows or []
 
-            # (prev) 1 2 3 (next) with prev/next only shown if there are any
-            paging = soup.find_all("div", class_='paging')
+        for task in parallel_map(_fetch, range(1, lastpage + 1), jobs):
+            if task.error is not None:
+                raise task.error
+            yield task.result
 
-            nexturl = None
-            if paging:
-                nextlink = paging[0].find('a', href=True, text=self._next_page)
-                if nextlink:
-                    nexturl = nextlink['href']
+    _page_re = re.compile(r'([?&](?:amp;)?page=)(\d+)')
 
-            yield self._parse_html_status(table)
+    def _parse_status_page(self, response):
+        """ find the grading table and paging information within a page
 
-            if nexturl is None:
-                # end of the iteration over the pages
-                return
+        The parsed page is not kept in the document cache so that it can
+        be released as soon as the rows have been extracted.
 
-            pagenum += 1
-            response = self.course.moodle.fetch(
-                nexturl,
-                _resid(),
-                force=force,
+        returns: the rows of the table (or `None` if there is no table),
+            the URL of the next page (or `None`) and the number of the
+            last page (or `None` if it cannot be determined)
+        """
+        soup = self.course.moodle.parse(response, cache=False)
+        region = soup.find(id='region-main')
+        if region is None:
+            return None, None, None
+        table = region.find('table')
+        if table is None:
+            return None, None, None
+        rows = list(self._status_rows(table))
+
+        # (prev) 1 2 3 (next) with prev/next only shown if there are any
+        paging = soup.find_all("div", class_='paging')
+
+        nexturl = None
+        lastpage = None
+        if paging:
+            nextlink = paging[0].find('a', href=True, text=self._next_page)
+            if nextlink:
+                nexturl = nextlink['href']
+
+            # page numbers in the URLs count from 0
+            pages = [
+                int(m.group(2)) for m in (
+                    self._page_re.search(a['href'])
+                    for a in paging[0].find_all('a', href=True)
+                ) if m
+            ]
+            if pages and nexturl is not None:
+                lastpage = max(pages)
+
+        return rows, nexturl, lastpage
+
+    # columns of the grading table that are extracted, keyed by a pattern
+    # that matches the column heading
+    _status_columns = [
+        ('.*First name.*Surname.*', 'Name'),
+        ('Username.*', 'Username'),
+        ('Status.*', 'Status'),
+        ('Grade.*', 'Grade'),
+        ('Final grade.*', 'Final grade'),
+    ]
+
+    # columns that must be present for the table to be understood; the
+    # others are filled with `None` if missing (e.g. ungraded assignments)
+    _required_status_columns = {'Username', 'Status'}
+
+    _whitespace_re = re.compile(r'\s+')
+
+    @classmethod
+    def _cell_text(cls, cell):
+        """ text of a table cell with whitespace collapsed, `None` if empty """
+        text = cls._whitespace_re.sub(' ', cell.get_text()).strip()
+        return text or None
+
+    @classmethod
+    def _expand_cells(cls, row):
+        """ text of the cells of a table row with colspans expanded """
+        cells = []
+        for cell in row.find_all(['td', 'th'], recursive=False):
+            try:
+                span = int(cell.get('colspan', 1))
+            except ValueError:
+                span = 1
+            cells.extend([cls._cell_text(cell)] * span)
+        return cells
+
+    @classmethod
+    def _status_rows(cls, table):
+        """ extract the interesting columns from a grading table
+
+        The header row is used to locate the name, username, status and
+        grade columns; the rows of the table are then walked once, yielding
+        a tuple of values (or `None` for empty cells) in the order of
+        `_status_columns`. The empty rows that Moodle uses to pad out the
+        table are skipped. Optional columns that are not in the table are
+        given as `None`.
+        """
+        rows = table.find_all('tr')
+        if not rows:
+            return
+
+        thead = table.find('thead')
+        header = thead.find('tr') if thead else rows[0]
+        headings = cls._expand_cells(header)
+
+        positions = []
+        for pattern, name in cls._status_columns:
+            for i, heading in enumerate(headings):
+                if heading and re.match(pattern, heading):
+                    positions.append(i)
+                    break
+            else:
+                if name in cls._required_status_columns:
+                    raise ValueError("Column '%s' not found in grading "
+                                     "table" % name)
+                positions.append(None)
+
+        for row in rows:
+            if row is header or row.find_parent('thead'):
+                continue
+            cells = cls._expand_cells(row)
+            values = tuple(
+                cells[i] if i is not None and i < len(cells) else None
+                for i in positions
             )
+            if any(v is not None for v in values):
+                yield values
 
     @staticmethod
-    def _parse_html_status(table):
-        """ read an html table of assignment data and extract information """
-        dfs = pandas.read_html(str(table))
-        df = dfs[0]
-        # moodle pads the end of the table with empty rows
-        df = df.dropna(how='all', axis=0)
-
-        cols = list(df.columns)
-
-        mapping = {
-            '.*First name.*Surname.*': 'Name',
-            'Username.*': 'Username',
-            'Status.*': 'Status',
-            'Grade.*': 'Grade',
-        }
+    def _numeric_column(values):
+        """ convert a column to numbers if all its values are numeric """
+        column = pandas.Series(values, dtype=object)
+        try:
+            return pandas.to_numeric(column)
+        except (ValueError, TypeError):
+            return column
+
+    @classmethod
+    def _status_frame(cls, pages):
+        """ assemble the pages of the grading table into a DataFrame
+
+        The rows of each page are appended to per-column lists as the page
+        arrives so that only the extracted values are held while the
+        remaining pages are fetched; the DataFrame is built once at the end
+        with the `Status` column stored as a categorical.
+
+        :param pages: iterable of lists of rows from `_status_rows`
+        """
+        names = [name for _, name in cls._status_columns]
+        columns = {name: [] for name in names}
+        for rows in pages:
+            for name, values in zip(names, zip(*rows)):
+                columns[name].extend(values)
 
-        for oldname, newname in mapping.items():
-            for i, colname in enumerate(cols):
-                cols[i] = re.sub(oldname, newname, colname)
+        columns['Status'] = pandas.Categorical(columns['Status'])
+        columns['Final grade'] = cls._numeric_column(columns['Final grade'])
 
-        df.columns = cols
+        df = pandas.DataFrame(columns, columns=names)
         df = df.set_index('Username')
 
         return df
 
-    def _fetch_status_data(self, force=False):
+    def _fetch_status_data(self, force=False, jobs=4, perpage=None):
         """ fetch assignment status information from the grading view
 
         :param force: bool, optional, default False
             force the data to be fetched from the server rather than using
             cached data
+        :param jobs: int, optional, default 4
+            number of pages of the grading table to download in parallel
+        :param perpage: int or 'all', optional, default `None`
+            number of rows per page of the grading table
         """
         if self.status is None or force:
-            df = pandas.concat(self._get_status_dataframes(force))
+            df = self._status_frame(
+                self._get_status_pages(force, jobs, perpage))
             self.status = df
         return self.status
 
-    def get_submission_status(self, force=False):
+    def get_submission_status(self, force=False, perpage=None):
         """ obtain information about the status of an assignment activity
 
         :param force: bool, optional, default False
             force the data to be fetched from the server rather than using
             cached data
+        :param perpage: int or 'all', optional, default `None`
+            number of rows per page when fetching the grading table
         """
-        df = self._fetch_status_data(force)
+        df = self._fetch_status_data(force, perpage=perpage)
         df = df[['Name', 'Status']].copy()
 
-        df.loc[df['Status'].isnull(), 'Status'] = self.course.status_missing
-        df['Status'].replace(
-            [r"^No submission.*", r"^Submitted.*"],
-            [self.course.status_missing, self.course.status_submitted],
-            inplace=True, regex=True
-        )
+        # relabel each distinct status once rather than every row
+        labels = {}
+        for status in df['Status'].cat.categories:
+            if re.match(r"^No submission", status):
+                labels[status] = self.course.status_missing
+            elif re.match(r"^Submitted", status):
+                labels[status] = self.course.status_submitted
+            else:
+                labels[status] = status
+
+        df['Status'] = df['Status'].astype(object).map(labels) \
+            .fillna(self.course.status_missing).astype('category')
 
         return df
 
-    def get_grades(self, force=False):
+    def get_grades(self, force=False, perpage=None):
         """ obtain information about grades in an assignment activity
 
         :param force: bool, optional, default False
             force the data to be fetched from the server rather than using
             cached data
+        :param perpage: int or 'all', optional, default `None`
+            number of rows per page when fetching the grading table
 
         Note that the grade in the assignment might be different to
         the grade in the gradebook due to the marking workflow (grades not
         yet released) or due to moderation by a Team Evaluation plugin.
         """
-        df = self._fetch_status_data(force)
+        df = self._fetch_status_data(force, perpage=perpage)
         df = df[['Name', 'Grade', 'Final grade']].copy()
 
         gradere = re.compile(r'Grade(\d+(.\d+)?).*')
 
         # raw grade column is "GradeXX / YY"
         df['Grade'] = pandas.to_numeric(
-            df.Grade.str.replace(gradere, lambda m: m.group(1)),
+            df.Grade.str.replace(gradere, lambda m: m.group(1), regex=True),
             errors='coerce',
         )
 
@@ -330,6 +530,7 @@ class Database(AbstractResource):
     """ Class representing a single Database activity within a course """
     _export_form_url = "mod/data/export.php?d=%s"
     _export_url = "mod/data/export.php?d=%s"
+    _export_form_template = "data-export-%s"
 
     #def __init__(self, *args, **kwargs):
         #super().__init__(*args, **kwargs)
@@ -357,6 +558,7 @@ class Database(AbstractResource):
             _clean,
             "database-export-%s-%s" % (fmt, self.id),
             force=force,
+            template=self._export_form_template % self.id,
         )
         return response, response.content
 
@@ -583,7 +785,7 @@ class Forum(AbstractResource):
             self._view_url % self.id,
             None
         )
-        bs = bs4.BeautifulSoup(page.text, 'lxml')
+        bs = self.course.moodle.parse(page)
 
         table = bs.find('table', class_='forumheaderlist')
         posts = table.find_all('tr', class_='discussion')
@@ -647,49 +849,54 @@ class Resource(AbstractResource):
 
     _download_url = "mod/resource/view.php?id=%s"
 
-    def _get_file_helper(self):
+    def _get_file_helper(self, stream=False):
         """ try various ways of extracting a resource
 
         The resource may be a direct link, a referring link or embedded
         within frames.
+
+        stream: bool, optional, default False
+            return the response for the file without downloading its body
         """
         page = self.course.moodle.fetch(
             self._download_url % self.id,
-            None
+            None,
+            stream=stream,
         )
         # The resource URL should magically 303 across to the actual file
         if page.history and page.history[0].status_code == 303:
-            return page, page.content
+            return page
 
         # If it doesn't 303 to the actual file then there might be a download
         # link to try
-        bs = bs4.BeautifulSoup(page.text, 'lxml')
+        bs = self.course.moodle.parse(page)
 
         div = bs.find('div', class_='resourceworkaround')
 
         if div:   # it's a link to the resource
-            link = div.find('a').href
+            link = div.find('a')['href']
 
-            page = self.course.moodle.fetch(
+            return self.course.moodle.fetch(
                 link,
-                None
+                None,
+                stream=stream,
             )
-            return page, page.content
 
         # Perhaps it's an embedded object
         obj = bs.find('object', id='resourceobject')
         if obj:
             link = obj['data']
 
-            page = self.course.moodle.fetch(
+            return self.course.moodle.fetch(
                 link,
-                None
+                None,
+                stream=stream,
             )
-            return page, page.content
 
         raise ValueError("No idea how to get that resource")
 
-    def get(self, save=False, filename=None):
+    def get(self, save=False, filename=None, stream=False, progress=None,
+            digest=None, resume=True):
         """ fetch a file from the resource
 
         save: bool
@@ -699,37 +906,172 @@ class Resource(AbstractResource):
             the filename not specified but `save` is `True` then the server
             specified filename will be used in the current directory. Be
             very careful not to overwrite resources with this!
+        stream: bool, optional, default False
+            write the file to disk in chunks as it is downloaded rather than
+            holding it in memory; requires `save`.
+        progress: callable, optional
+            for streamed downloads, called as `progress(done, total)` as the
+            file is written (see `utils.stream_to_file`)
+        digest: hashlib hash object, optional
+            for streamed downloads, updated with the content of the file as
+            it is written
+        resume: bool, optional, default True
+            for streamed downloads, keep the partially downloaded file if
+            the download fails and resume from where it stopped next time
+            (see `Moodle.download`)
 
         returns:
-            file contents (binary), filename
+            file contents (binary), filename; the contents are `None` for
+            streamed downloads
         """
-        page, content = self._get_file_helper()
+        if stream and not save:
+            raise ValueError("Streamed downloads must be saved to a file")
+
+        page = self._get_file_helper(stream)
 
         filename = _negotiate_filename(page, filename, save)
 
+        if stream:
+            self.course.moodle.download(page, filename, progress=progress,
+                                        digest=digest, resume=resume)
+            return None, filename
+
+        content = page.content
         if save and filename:
             with open(filename, 'wb') as fh:
                 fh.write(content)
 
         return content, filename
 
-    _upload_url = "course/modedit.php?update=%s"
+    _draft_upload_url = "repository/repository_ajax.php?action=upload"
+    _draft_files_url = "repository/draftfiles_ajax.php?action=%s"
 
-    def put(self, filename):
-        """ put an updated copy of a file into the specified resource """
-        def _clean(payload):
-            payload.pop("nosubmit_checkbox_controller1", None)
-            return payload
+    # the file manager configuration is in the javascript of the form page
+    _upload_repo_re = re.compile(r'\{"id":"(\d+)","name":"[^"]*",'
+                                 r'"type":"upload"')
+    _context_re = re.compile(r'"context":\{"id":(\d+)')
+
+    def put(self, filename, progress=None):
+        """ put an updated copy of a file into the specified resource
+
+        The file is uploaded into the draft file area of the resource's
+        settings form, replacing the files that are already there, and the
+        settings form is then saved. The file is streamed from disk rather
+        than being read into memory.
+
+        filename: str
+            the file to upload
+        progress: callable, optional
+            called as `progress(done, total)` as the upload is sent
+
+        returns: requests.Response
+            the response from saving the settings form
+
+        raises: ValueError if the upload or the settings are rejected
+        """
+        moodle = self.course.moodle
+
+        # the draft area belongs to this instance of the form, so the form
+        # must be submitted with this payload rather than refetched
+        form, payload = moodle.fetch_form(
+            self._settings_get_form_url.format(id=self.id), submitted=True)
+
+        repo = self._upload_repo_re.search(form.text)
+        context = self._context_re.search(form.text)
+        if not repo or not context or not payload.get('files'):
+            raise ValueError("No file upload area found in resource form")
+
+        itemid = payload['files']
+        self._clear_draft_area(itemid)
+
+        body = MultipartStream(
+            {
+                'sesskey': moodle.sesskey(),
+                'repo_id': repo.group(1),
+                'itemid': itemid,
+                'ctx_id': context.group(1),
+                'savepath': '/',
+                'title': os.path.basename(filename),
+                'author': '',
+            },
+            {'repo_upload_file': filename},
+            progress=progress,
+        )
+        logger.debug("Uploading %s (%d bytes)", filename, len(body))
+        response = moodle.session.post(
+            moodle.url(self._draft_upload_url),
+            data=body,
+            headers={'Content-Type': body.content_type},
+        )
+        response.raise_for_status()
+        result = response.json()
+        if 'error' in result:
+            raise ValueError("Upload failed: %s" % result['error'])
+
+        for key in ('cancel', 'submitbutton'):
+            payload.pop(key, None)
+        payload.pop("nosubmit_checkbox_controller1", None)
 
-        # load up the files to be sent
-        files = {
-            'name': open(filename, 'rb'),
-            'futz': self.id
+        response = moodle.session.post(
+            moodle.url(self._settings_set_form_url), data=payload)
+        logger.debug("Sent data, status code: %s", response.status_code)
+        response.raise_for_status()
+
+        # Moodle redirects away from the form once the settings are saved
+        # and shows the form again if they were rejected
+        if not response.history:
+            raise ValueError("Resource settings were not saved")
+        return response
+
+    def _clear_draft_area(self, itemid):
+        """ remove the existing files from a draft file area """
+        moodle = self.course.moodle
+        data = {
+            'sesskey': moodle.sesskey(),
+            'itemid': itemid,
+            'filepath': '/',
         }
 
-        files[self.id] = self.id
-        # FIXME
-        raise NotImplementedError()
+        response = moodle.session.post(
+            moodle.url(self._draft_files_url % 'list'), data=data)
+        response.raise_for_status()
+        listing = response.json()
+
+        for entry in listing.get('list', []):
+            if entry.get('type') == 'folder':
+                continue
+            logger.debug("Removing draft file %s", entry['filename'])
+            response = moodle.session.post(
+                moodle.url(self._draft_files_url % 'delete'),
+                data=dict(data, filename=entry['filename'],
+                          filepath=entry.get('filepath', '/')),
+            )
+            response.raise_for_status()
+
+
+class Folder(Resource):
+    """ Class representing a Folder of files within a course
+
+    The contents of the folder are downloaded as a single zip file.
+    """
+
+    _download_url = "mod/folder/download_folder.php?id=%s"
+
+    def _get_file_helper(self, stream=False):
+        """ fetch the zip file of the folder contents
+
+        stream: bool, optional, default False
+            return the response for the file without downloading its body
+        """
+        return self.course.moodle.fetch(
+            self._download_url % self.id,
+            None,
+            stream=stream,
+        )
+
+    def put(self, filename, progress=None):
+        """ uploading files into folders is not supported """
+        raise NotImplementedError("Files cannot be uploaded to a Folder")
 
 
 def _negotiate_filename(page, filename, save):
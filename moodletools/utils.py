@@ -4,14 +4,660 @@
 
 # Copyright (c) 2017-2018 Stuart Prescott
 
+import atexit
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
 import logging
+import mimetypes
 import os
-import pickle
+import re
+import sqlite3
+import tempfile
+import threading
 import time
+import uuid
+
+import bs4
+import requests
+import requests.structures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
 
+def _zstd_open(filename):
+    """ open a zstd compressed file for streaming decompression """
+    if zstandard is None:
+        raise CacheMissError("zstandard module needed to read %s" % filename)
+    return zstandard.ZstdDecompressor().stream_reader(
+        open(filename, 'rb'), closefd=True)
+
+
+def _zstd_compress(content):
+    return zstandard.ZstdCompressor().compress(content)
+
+
+# compression methods for cached payloads:
+#    name: (filename suffix, compression function, streaming opener)
+_codecs = {
+    None: ('', None, lambda filename: open(filename, 'rb')),
+    'gzip': ('.gz', gzip.compress, lambda filename: gzip.open(filename, 'rb')),
+    'zstd': ('.zst', _zstd_compress, _zstd_open),
+}
+
+
+class CacheStore:
+    """ Content-addressed storage of cached resources
+
+    The metadata for each resource in the cache is held in a single SQLite
+    index within the cache directory, while the payloads are stored in a
+    directory of blobs named by the SHA-256 hash of their content. Identical
+    payloads fetched under different resource ids are thus stored only once.
+
+    There is one store per cache directory; use :meth:`open` rather than
+    constructing instances directly so that the index connection is shared.
+    The store may be used from multiple threads.
+
+    The size of the store can be bounded by a budget of bytes (counting
+    the size on disk of each payload once) and of entries; when a new entry
+    takes the store over budget, the least recently used entries are
+    evicted.
+
+    Payloads may be stored compressed with gzip or zstd (if the zstandard
+    module is available); the compression method is recorded in the index
+    and payloads are decompressed as they are read.
+
+    :param directory: str, the cache directory
+    :param max_bytes: int, optional, default `None`.
+        The maximum total size of the payloads in the store
+    :param max_entries: int, optional, default `None`.
+        The maximum number of entries in the store
+    """
+    _index_filename = "index.sqlite"
+    _blob_directory = "blobs"
+
+    _schema_version = 5
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS entries (
+            resid TEXT PRIMARY KEY,
+            url TEXT,
+            status INTEGER,
+            reason TEXT,
+            encoding TEXT,
+            headers TEXT,
+            history TEXT,
+            fetched_at REAL,
+            last_access REAL,
+            size INTEGER,
+            hash TEXT,
+            codec TEXT,
+            stored_size INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+        CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS derived (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes=None, max_entries=None):
+        self.directory = directory
+        self.blobs = os.path.join(directory, self._blob_directory)
+        os.makedirs(self.blobs, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, self._index_filename),
+            check_same_thread=False,
+        )
+        self._db.row_factory = sqlite3.Row
+        self._upgrade()
+
+        self._pending_access = {}
+        self._pending_counts = collections.Counter()
+        atexit.register(self.flush)
+
+    def _upgrade(self):
+        """ create the index, discarding one with an old layout
+
+        The cache is disposable so older indexes are simply replaced; any
+        payloads left behind are removed by :meth:`gc`.
+        """
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self._schema_version:
+            logger.debug("Replacing cache index version %d", version)
+            self._db.executescript("""
+                DROP TABLE IF EXISTS entries;
+                DROP TABLE IF EXISTS counters;
+                DROP TABLE IF EXISTS derived;
+            """)
+        self._db.executescript(self._schema)
+        self._db.execute("PRAGMA user_version = %d" % self._schema_version)
+
+    @classmethod
+    def open(cls, directory, max_bytes=None, max_entries=None):
+        """ return the (shared) store for the cache directory
+
+        Budgets that are specified replace those of an already open store.
+        """
+        key = os.path.realpath(directory)
+        with cls._stores_lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls(directory, max_bytes, max_entries)
+                cls._stores[key] = store
+            else:
+                if max_bytes is not None:
+                    store.max_bytes = max_bytes
+                if max_entries is not None:
+                    store.max_entries = max_entries
+            return store
+
+    def blob_filename(self, digest, codec=None):
+        """ the file path for the payload with the specified hash """
+        suffix = _codecs[codec][0]
+        return os.path.join(self.blobs, digest[:2], digest[2:] + suffix)
+
+    def open_blob(self, digest, codec=None):
+        """ return a file object that reads the (decompressed) payload """
+        return _codecs[codec][2](self.blob_filename(digest, codec))
+
+    def lookup(self, resid):
+        """ return the index entry for the resource or `None` """
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM entries WHERE resid = ?", (resid,)
+            ).fetchone()
+
+    def refresh(self, resid, headers):
+        """ mark a resource as freshly fetched, updating its headers """
+        self.flush()
+        now = time.time()
+        with self._lock, self._db:
+            entry = self.lookup(resid)
+            if entry is None:
+                return None
+            updated = set(name.lower() for name in headers)
+            merged = {
+                name: value
+                for name, value in json.loads(entry['headers']).items()
+                if name.lower() not in updated
+            }
+            merged.update(headers)
+            self._db.execute(
+                "UPDATE entries SET fetched_at = ?, last_access = ?, "
+                "headers = ? WHERE resid = ?",
+                (now, now, json.dumps(merged), resid)
+            )
+            return self.lookup(resid)
+
+    def get_value(self, key):
+        """ return a stored JSON-serialisable value or `None` """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM derived WHERE key = ?', (key,)
+            ).fetchone()
+        return json.loads(row['value']) if row else None
+
+    def set_value(self, key, value):
+        """ store a JSON-serialisable value derived from cached resources """
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO derived (key, value) VALUES (?, ?)',
+                (key, json.dumps(value))
+            )
+
+    # access times and usage counters are held in memory and written to the
+    # index in a single transaction with the next change to the index (or
+    # after this many updates) so that reading from the cache does not
+    # cost a synchronous write each time
+    _flush_every = 64
+
+    def touch(self, resid):
+        """ mark the resource as recently used """
+        with self._lock:
+            self._pending_access[resid] = time.time()
+            pending = len(self._pending_access)
+        if pending >= self._flush_every:
+            self.flush()
+
+    def count(self, name, increment=1):
+        """ increment one of the persistent usage counters """
+        with self._lock:
+            self._pending_counts[name] += increment
+
+    def flush(self):
+        """ write the pending access times and usage counters """
+        with self._lock:
+            if not self._pending_access and not self._pending_counts:
+                return
+            access, self._pending_access = self._pending_access, {}
+            counts, self._pending_counts = \
+                self._pending_counts, collections.Counter()
+            with self._db:
+                self._db.executemany(
+                    "UPDATE entries SET last_access = ? WHERE resid = ?",
+                    [(when, resid) for resid, when in access.items()]
+                )
+                for name, increment in counts.items():
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO counters (name, value) "
+                        "VALUES (?, 0)", (name,)
+                    )
+                    self._db.execute(
+                        "UPDATE counters SET value = value + ? "
+                        "WHERE name = ?", (increment, name)
+                    )
+
+    def read_blob(self, digest, codec=None):
+        """ return the payload with the specified hash """
+        with self.open_blob(digest, codec) as fh:
+            return fh.read()
+
+    def write_blob(self, content, codec=None):
+        """ store a payload, returning its hash, codec and size on disk
+
+        If the payload is already stored, it is not stored again and the
+        codec of the existing copy is returned.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        for existing in _codecs:
+            filename = self.blob_filename(digest, existing)
+            if os.path.exists(filename):
+                logger.debug("Payload %s already in cache", digest)
+                return digest, existing, os.path.getsize(filename)
+
+        compress = _codecs[codec][1]
+        data = compress(content) if compress else content
+
+        filename = self.blob_filename(digest, codec)
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+
+        # write atomically so that concurrent readers never see partial data
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmpname, filename)
+        return digest, codec, len(data)
+
+    def store(self, resid, url, status, headers, size, digest,
+              reason=None, encoding=None, history=None,
+              codec=None, stored_size=None):
+        """ add or replace the index entry for a resource
+
+        :param history: list of dict, optional.
+            summary of the redirects that lead to the resource, each with
+            the keys 'url', 'status', 'reason' and 'headers'
+        """
+        self.flush()
+        now = time.time()
+        with self._lock, self._db:
+            old = self.lookup(resid)
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(resid, url, status, reason, encoding, headers, history, "
+                "fetched_at, last_access, size, hash, codec, stored_size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (resid, url, status, reason, encoding, json.dumps(headers),
+                 json.dumps(history or []), now, now, size, digest, codec,
+                 size if stored_size is None else stored_size)
+            )
+            if old is not None and old['hash'] != digest:
+                self._release_blob(old['hash'])
+        self.evict()
+
+    def remove(self, resid):
+        """ remove the index entry for a resource and unused payloads """
+        with self._lock, self._db:
+            old = self.lookup(resid)
+            if old is None:
+                return False
+            self._db.execute("DELETE FROM entries WHERE resid = ?", (resid,))
+            self._release_blob(old['hash'])
+            return True
+
+    def _release_blob(self, digest):
+        """ delete a payload if no entry in the index refers to it
+
+        returns: bool, whether the payload is no longer stored
+        """
+        if digest is None:
+            return False
+
+        used = self._db.execute(
+            "SELECT 1 FROM entries WHERE hash = ? LIMIT 1", (digest,)
+        ).fetchone()
+        if used:
+            return False
+
+        for codec in _codecs:
+            try:
+                os.remove(self.blob_filename(digest, codec))
+                logger.debug("Removed payload %s from cache", digest)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def totals(self):
+        """ return the number of entries and size on disk of the payloads """
+        with self._lock:
+            entries = self._db.execute(
+                "SELECT COUNT(*) FROM entries").fetchone()[0]
+            size = self._db.execute(
+                "SELECT COALESCE(SUM(stored_size), 0) FROM "
+                "(SELECT DISTINCT hash, stored_size FROM entries)"
+            ).fetchone()[0]
+        return entries, size
+
+    def _over_budget(self, entries, size):
+        return ((self.max_entries is not None and entries > self.max_entries)
+                or (self.max_bytes is not None and size > self.max_bytes))
+
+    def evict(self, max_age=None):
+        """ remove entries to bring the store within its budget
+
+        Expired entries are removed first (if `max_age` is given) and then
+        the least recently used entries until the store is within the byte
+        and entry budgets.
+
+        :param max_age: int, optional, default `None`.
+            remove entries fetched more than this many seconds ago
+
+        returns: int, the number of entries removed
+        """
+        if max_age is None and self.max_bytes is None and \
+                self.max_entries is None:
+            # nothing to enforce; avoid scanning the whole index
+            return 0
+
+        # the least recently used entries need the current access times
+        self.flush()
+        removed = 0
+        with self._lock, self._db:
+            if max_age is not None:
+                expired = self._db.execute(
+                    "SELECT resid FROM entries WHERE fetched_at < ?",
+                    (time.time() - max_age,)
+                ).fetchall()
+                for row in expired:
+                    self.remove(row['resid'])
+                removed += len(expired)
+
+            entries, size = self.totals()
+            if not self._over_budget(entries, size):
+                return removed
+
+            rows = self._db.execute(
+                "SELECT resid, hash, stored_size FROM entries "
+                "ORDER BY last_access"
+            ).fetchall()
+            for row in rows:
+                if not self._over_budget(entries, size):
+                    break
+                self._db.execute(
+                    "DELETE FROM entries WHERE resid = ?", (row['resid'],))
+                if self._release_blob(row['hash']):
+                    size -= row['stored_size']
+                entries -= 1
+                removed += 1
+                logger.debug("Evicted %s from cache", row['resid'])
+
+        return removed
+
+    def gc(self, max_age=None):
+        """ enforce the budgets and remove unreferenced payload files
+
+        :param max_age: int, optional, default `None`.
+            remove entries fetched more than this many seconds ago
+
+        returns: (int, int), the number of entries and orphaned payload
+            files (including those from older cache layouts) that were
+            removed
+        """
+        removed = self.evict(max_age)
+        orphans = 0
+
+        with self._lock:
+            known = set(
+                row[0] for row in
+                self._db.execute("SELECT DISTINCT hash FROM entries")
+            )
+            for dirpath, _, filenames in os.walk(self.blobs):
+                prefix = os.path.basename(dirpath)
+                for filename in filenames:
+                    digest = prefix + filename.partition('.')[0]
+                    if digest in known:
+                        continue
+                    os.remove(os.path.join(dirpath, filename))
+                    orphans += 1
+
+            # files cached with the older one-file-per-resource layout
+            # (<resid> and <resid>.response) are no longer read
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or \
+                        entry.name.startswith(self._index_filename):
+                    continue
+                os.remove(entry.path)
+                orphans += 1
+
+        return removed, orphans
+
+    def stats(self, top=10):
+        """ return a summary of the contents and usage of the store
+
+        :param top: int, optional, default 10.
+            the number of largest entries to include
+
+        returns: dict
+        """
+        self.flush()
+        entries, size = self.totals()
+        with self._lock:
+            counters = dict(
+                (row['name'], row['value']) for row in
+                self._db.execute("SELECT name, value FROM counters")
+            )
+            logical = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            biggest = self._db.execute(
+                "SELECT resid, size, stored_size, codec, fetched_at, "
+                "last_access FROM entries ORDER BY stored_size DESC LIMIT ?",
+                (top,)
+            ).fetchall()
+
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        lookups = hits + misses
+
+        return {
+            'entries': entries,
+            'size': size,
+            'logical_size': logical,
+            'max_bytes': self.max_bytes,
+            'max_entries': self.max_entries,
+            'hits': hits,
+            'misses': misses,
+            'revalidated': counters.get('revalidated', 0),
+            'hit_rate': hits / lookups if lookups else None,
+            'biggest': [dict(row) for row in biggest],
+        }
+
+
+class MemoryCache:
+    """ In-process cache of Response objects in front of the on-disk cache
+
+    Repeatedly loading the same resource from the on-disk cache costs a
+    database lookup, reading the payload and recreating the Response
+    object; this bounded least-recently-used cache holds the most recently
+    used Response objects in memory so that repeated reads are free.
+
+    A MemoryCache is intended to be shared by all Cacher objects created
+    by a Moodle instance and may be used from multiple threads.
+
+    :param max_bytes: int, optional, default 64 MiB.
+        The maximum total size of the payloads held in memory
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, max_age):
+        """ return the Response object if held and fresh, otherwise `None` """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or time.time() >= entry[0] + max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, name, response, fetched_at=None, size=None):
+        """ hold a Response object in memory, evicting older entries
+
+        The size of the content should be given for responses whose content
+        has not yet been loaded so that it is not read just to be measured.
+        """
+        if size is None:
+            size = len(response.content)
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        with self._lock:
+            self._discard(name)
+            if size > self.max_bytes:
+                return
+            self._entries[name] = (fetched_at, size, response)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, oldsize, _) = self._entries.popitem(last=False)
+                self.size -= oldsize
+
+    def discard(self, name):
+        """ remove a Response object from memory """
+        with self._lock:
+            self._discard(name)
+
+    def _discard(self, name):
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        """ remove all Response objects from memory """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ return a summary of the contents and usage of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+class SoupCache:
+    """ In-process cache of parsed HTML documents
+
+    Several parts of the code parse the same downloaded page (for example,
+    harvesting the sesskey and listing the activities on the course page);
+    this bounded least-recently-used cache ensures that each page is parsed
+    only once, keyed by the hash of the page content.
+
+    The parsed documents are shared and so must not be modified.
+
+    :param max_entries: int, optional, default 8.
+        The maximum number of parsed documents to hold
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, content, parser='lxml', parse_only=None, cache=True):
+        """ return the BeautifulSoup document for the content
+
+        If the whole document has already been parsed, it is returned even
+        if only part of the document (`parse_only`) was requested.
+
+        :param content: str or bytes, the HTML to parse
+        :param parser: str, optional, default 'lxml'.
+            the parser for BeautifulSoup to use
+        :param parse_only: bs4.SoupStrainer, optional, default `None`.
+            restrict parsing to matching parts of the document; the
+            strainer should be a module level constant so that it can
+            be used as part of the key.
+        :param cache: bool, optional, default `True`.
+            store the newly parsed document in the cache; an already cached
+            document is still returned if there is one.
+        """
+        data = content.encode('utf-8') if isinstance(content, str) \
+            else content
+        digest = hashlib.sha1(data).hexdigest()
+
+        keys = [(digest, parser, None)]
+        if parse_only is not None:
+            keys.append((digest, parser, parse_only))
+
+        with self._lock:
+            for key in keys:
+                soup = self._entries.get(key)
+                if soup is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return soup
+            self.misses += 1
+
+        soup = bs4.BeautifulSoup(content, parser, parse_only=parse_only)
+        if not cache:
+            return soup
+
+        with self._lock:
+            self._entries[keys[-1]] = soup
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return soup
+
+    def clear(self):
+        """ remove all parsed documents """
+        with self._lock:
+            self._entries.clear()
+
+
 class Cacher:
     """ On-disk caching for resources
 
@@ -20,14 +666,15 @@ class Cacher:
     code, particularly during development or during repeated operations.
 
     This class is designed to accept requests.Response objects and save
-    both the pickled Response object and also the data that was in the
-    response payload. Only the Response object is rehydrated from the
-    cache.
+    them into a :class:`CacheStore`: the payload of the response is saved
+    into the content-addressed blob store while the status, URL, headers
+    and a summary of any redirects are saved in the index. A
+    :class:`CachedResponse` is rehydrated from the cache, with the payload
+    only being read when it is used.
 
-    :param name: str, the resource id in the cache; will be used as the
-        filename for the pickled object.
+    :param name: str, the resource id in the cache.
     :param payload: bool, optional, default `True`.
-        Separately save the payload from the Response object
+        Retained for compatibility; the payload is always saved.
     :param cache: str, optional, default `cache`.
         The directory into which the cache will be written.
     :param max_age: int, optional, default 3600.
@@ -36,41 +683,89 @@ class Cacher:
         be raised.
     :param force: bool, optional, default `False`.
         Redownload will be forced.
+    :param max_bytes: int, optional, default `None`.
+        The byte budget of the cache, see :class:`CacheStore`.
+    :param max_entries: int, optional, default `None`.
+        The entry budget of the cache, see :class:`CacheStore`.
+    :param memory: MemoryCache, optional, default `None`.
+        An in-memory cache that is consulted before the on-disk cache.
+    :param compression: str, optional, default `None`.
+        Compression method for payloads, either 'gzip' or 'zstd'; `None`
+        stores payloads uncompressed.
     """
     def __init__(self, name, payload=True,
-                 cache='cache', max_age=3600, force=False):
+                 cache='cache', max_age=3600, force=False,
+                 max_bytes=None, max_entries=None, memory=None,
+                 compression=None):
         self.name = name
         self.payload = payload
         self.cache = cache
         self.cache_max_age = max_age
         self.force = force
+        self.memory = memory
+        self.compression = _check_compression(compression)
 
-        if self.enabled and not os.path.exists(self.cache):
-            os.mkdir(self.cache)
+        self.store = None
+        if self.enabled:
+            self.store = CacheStore.open(self.cache, max_bytes, max_entries)
 
     @property
     def enabled(self):
         """ The cache is enabled for both read and write """
         return self.name and self.cache is not None
 
-    def _cache_filename(self):
-        """ the file path for the Response object """
-        return os.path.join(self.cache, self.name + ".response")
-
-    def _cache_payload_filename(self):
-        """ the file path for the payload object """
-        return os.path.join(self.cache, self.name)
+    # response headers that can validate a stale entry, and the request
+    # headers used to do so
+    _validators = {
+        'ETag': 'If-None-Match',
+        'Last-Modified': 'If-Modified-Since',
+    }
 
-    def _cache_ok(self):
-        """ the cache object exists and is usable """
+    def _cache_entry(self):
+        """ the index entry for the cached object and whether it is fresh """
         if not self.enabled:
-            return False
+            return None, False
 
-        try:
-            mtime = os.path.getmtime(self._cache_filename())
-        except FileNotFoundError:
-            return False
-        return time.time() < mtime + self.cache_max_age
+        entry = self.store.lookup(self.name)
+        if entry is None:
+            return None, False
+        fresh = time.time() < entry['fetched_at'] + self.cache_max_age
+        return entry, fresh
+
+    def _rehydrate(self, entry):
+        """ recreate the Response object from the index entry """
+        digest, codec = entry['hash'], entry['codec']
+        filename = self.store.blob_filename(digest, codec)
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+
+        response = CachedResponse.from_summary(
+            {
+                'url': entry['url'],
+                'status': entry['status'],
+                'reason': entry['reason'],
+                'headers': json.loads(entry['headers']),
+            },
+            payload=_LazyFile(
+                lambda: self.store.open_blob(digest, codec)),
+        )
+        response.encoding = entry['encoding']
+        response.content_hash = digest
+        response.history = [
+            CachedResponse.from_summary(h)
+            for h in json.loads(entry['history'])
+        ]
+        return response
+
+    def _stale_validators(self, entry):
+        """ request headers for a conditional GET of a stale entry """
+        headers = json.loads(entry['headers'])
+        found = {}
+        for name, value in headers.items():
+            for validator, request_header in self._validators.items():
+                if name.lower() == validator.lower():
+                    found[request_header] = value
+        return found
 
     def load(self):
         """ attempt to load the cached resource
@@ -79,36 +774,237 @@ class Cacher:
         resource does not exist or the cached resource is too old,
         a CacheMissError is raised to permit the controlling code to
         otherwise download the resource.
+
+        If the cached resource is too old but the server had provided
+        validators (ETag or Last-Modified headers) for it, the more specific
+        CacheStaleError is raised so that the controlling code can ask the
+        server whether the resource has changed; :meth:`refresh` will then
+        load the cached resource if it has not.
         """
-        if not self.force and self._cache_ok():
-            filename = self._cache_filename()
-            logger.debug("Looking for %s in cache", filename)
-            with open(filename, 'rb') as fh:
-                return pickle.load(fh)
+        if self.enabled and self.memory is not None and not self.force:
+            response = self.memory.get(self.name, self.cache_max_age)
+            if response is not None:
+                logger.debug("Found %s in memory cache", self.name)
+                return response
+
+        entry, fresh = (None, False) if self.force else self._cache_entry()
+        if entry is not None and fresh:
+            logger.debug("Looking for %s in cache", self.name)
+            try:
+                response = self._rehydrate(entry)
+                self.store.touch(self.name)
+                self.store.count('hits')
+                if self.memory is not None:
+                    self.memory.put(self.name, response, entry['fetched_at'],
+                                    entry['size'])
+                return response
+            except FileNotFoundError:
+                logger.warning("Payload for %s missing from cache",
+                               self.name)
+                entry = None
         else:
             logger.debug("No cache")
 
+        if self.enabled:
+            self.store.count('misses')
+
+        if entry is not None:
+            validators = self._stale_validators(entry)
+            if validators:
+                raise CacheStaleError(validators)
+
         raise CacheMissError
 
-    def save(self, response):
+    def refresh(self, response):
+        """ load the cached resource after the server confirmed it is current
+
+        :param response: requests.Response, the "304 Not Modified" response
+            from the server; any updated headers are stored
+
+        A CacheMissError is raised if the entry or its payload has been
+        removed from the cache since it was loaded.
+
+        returns: the cached requests.Response object
+        """
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() in ('etag', 'last-modified', 'expires',
+                                'cache-control', 'date')
+        }
+        entry = self.store.refresh(self.name, headers)
+        if entry is None:
+            raise CacheMissError
+        logger.debug("Revalidated %s in cache", self.name)
+        try:
+            response = self._rehydrate(entry)
+        except FileNotFoundError:
+            logger.warning("Payload for %s missing from cache", self.name)
+            raise CacheMissError
+        self.store.count('revalidated')
+        if self.memory is not None:
+            self.memory.put(self.name, response, entry['fetched_at'],
+                            entry['size'])
+        return response
+
+    # payloads smaller than this are not worth compressing
+    _compress_min_size = 1024
+
+    # content types that are already compressed
+    _compressed_types = re.compile(
+        r"^(application/(zip|x-zip|gzip|x-gzip|x-7z|x-rar|x-bzip2|pdf|"
+        r"vnd\.openxmlformats|vnd\.oasis\.opendocument|octet-stream)|"
+        r"image/(?!svg)|audio/|video/)")
+
+    def _codec(self, response, compress):
+        """ the compression method to use for the payload of a response """
+        if self.compression is None or compress is False:
+            return None
+        if compress is None:
+            content_type = response.headers.get('content-type', '')
+            if self._compressed_types.match(content_type.lower()):
+                return None
+            if len(response.content) < self._compress_min_size:
+                return None
+        return self.compression
+
+    def save(self, response, compress=None):
         """ save the response data into the cache
 
-        If the cache is disabled, the response is not saved. Both
-        response any payload can be saved into separate files.
+        If the cache is disabled, the response is not saved. The payload
+        is saved into the blob store and the response into the index.
+
+        :param compress: bool, optional, default `None`.
+            whether the payload should be compressed (if compression is
+            enabled); if `None`, payloads that are small or whose content
+            type shows they are already compressed (zip, xlsx, images etc)
+            are stored uncompressed.
         """
         if not self.enabled:
             logger.debug("Cache disabled, not saving")
             return
 
-        filename = self._cache_payload_filename()
-        with open(filename, 'wb') as fh:
-            logger.debug("Caching payload to %s", filename)
-            fh.write(response.content)
+        content = response.content
+        logger.debug("Caching response for %s", self.name)
+        digest, codec, stored_size = self.store.write_blob(
+            content, self._codec(response, compress))
+
+        self.store.store(
+            self.name,
+            response.url,
+            response.status_code,
+            dict(response.headers),
+            len(content),
+            digest,
+            reason=response.reason,
+            encoding=response.encoding,
+            history=[CachedResponse.summary(h) for h in response.history],
+            codec=codec,
+            stored_size=stored_size,
+        )
+        if self.memory is not None:
+            self.memory.put(self.name, response, size=len(content))
+
+    def clear(self):
+        """ remove the resource from the cache """
+        if not self.enabled:
+            return
+
+        if self.memory is not None:
+            self.memory.discard(self.name)
+        if self.store.remove(self.name):
+            logger.debug("Removed %s from cache", self.name)
 
-        filename = self._cache_filename()
-        with open(filename, 'wb') as fh:
-            logger.debug("Caching response to %s", filename)
-            pickle.dump(response, fh)
+
+class CachedResponse(requests.Response):
+    """ requests.Response object rehydrated from the cache
+
+    The payload of the response is read from the cache only when the
+    `content` (or `text`) of the response is used; `iter_content` streams
+    the payload from the cache without reading it all into memory.
+    """
+    @classmethod
+    def from_summary(cls, summary, payload=None):
+        """ create a response from its summary and an optional payload
+
+        :param summary: dict, as created by :meth:`summary`
+        :param payload: file-like object, optional, default `None`.
+            the source of the payload of the response; if `None`, the
+            response has no payload.
+        """
+        response = cls()
+        response.url = summary['url']
+        response.status_code = summary['status']
+        response.reason = summary['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            summary['headers'])
+        if payload is None:
+            response._content = b''
+        else:
+            response.raw = payload
+        return response
+
+    @staticmethod
+    def summary(response):
+        """ summarise the status, URL and headers of a response """
+        return {
+            'url': response.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+        }
+
+    @property
+    def content(self):
+        if self._content is False and not self._content_consumed \
+                and self.raw is not None:
+            # read in one go rather than in iter_content's small chunks
+            self._content = self.raw.read()
+            self._content_consumed = True
+            self.raw.close()
+        return super().content
+
+
+class _LazyFile:
+    """ read-only file that is not opened until it is first read
+
+    :param opener: callable that returns the file object
+    """
+    def __init__(self, opener):
+        self.opener = opener
+        self._fh = None
+        self._closed = False
+
+    def read(self, size=-1):
+        if self._closed:
+            return b''
+        if self._fh is None:
+            self._fh = self.opener()
+        data = self._fh.read(size)
+        if not data or size is None or size < 0:
+            self.close()
+        return data
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self._closed = True
+
+
+def _check_compression(compression):
+    """ validate the configured compression method for the cache """
+    if compression not in _codecs:
+        raise ValueError("Unknown cache compression '%s'" % compression)
+    if compression == 'zstd' and zstandard is None:
+        if not _check_compression.warned:
+            logger.warning("zstandard module not available; "
+                           "using gzip compression for the cache")
+            _check_compression.warned = True
+        return 'gzip'
+    return compression
+
+
+_check_compression.warned = False
 
 
 class CacheMissError(Exception):
@@ -125,6 +1021,19 @@ class CacheMissError(Exception):
     pass
 
 
+class CacheStaleError(CacheMissError):
+    """ Raised when the cached resource is too old but can be revalidated
+
+    The calling code may make a conditional request to the server using
+    the request headers in `validators`; if the server responds that the
+    resource is not modified, :meth:`Cacher.refresh` will return the
+    cached resource.
+    """
+    def __init__(self, validators):
+        super().__init__(validators)
+        self.validators = validators
+
+
 def resid_factory(source, name='generic-%s', resid='auto'):
     """ create a cache resource identifier on demand
 
@@ -142,3 +1051,303 @@ def resid_factory(source, name='generic-%s', resid='auto'):
         return name.format(id=source.id)
 
     return resid
+
+
+TaskResult = collections.namedtuple(
+    'TaskResult',
+    [
+        'item',
+        'result',
+        'error',
+    ]
+)
+
+
+def parallel_map(func, items, jobs=1):
+    """ apply a function to each item, optionally using a pool of threads
+
+    Exceptions raised by `func` are caught and recorded against the item
+    rather than aborting the other items, so that the caller can report
+    on the success or failure of each one.
+
+    :param func: callable, the function to apply to each item
+    :param items: iterable of the items to be processed
+    :param jobs: int, optional, default 1.
+        The maximum number of items to process at once; 1 processes
+        the items serially in the calling thread.
+
+    :returns: generator of TaskResult, yielded in the same order as `items`
+    """
+    def _run(item):
+        try:
+            return TaskResult(item, func(item), None)
+        except Exception as exc:   # pylint: disable=broad-except
+            logger.debug("Task failed for %s: %s", item, exc)
+            return TaskResult(item, None, exc)
+
+    if jobs is None or jobs <= 1:
+        for item in items:
+            yield _run(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(_run, items)
+
+
+def stream_to_file(response, filename, chunk_size=1024*1024,
+                   progress=None, digest=None, offset=0):
+    """ write the body of a streamed response to a file
+
+    The body is written in chunks as it arrives so that memory use does
+    not depend on the size of the file.
+
+    :param response: requests.Response, fetched with `stream=True`
+    :param filename: str, the file to write
+    :param chunk_size: int, optional, default 1 MiB.
+        The number of bytes to read from the server at a time
+    :param progress: callable, optional, default `None`.
+        Called after each chunk as `progress(done, total)` with the number
+        of bytes written so far and the expected size of the file (or
+        `None` if the server did not say).
+    :param digest: hashlib hash object, optional, default `None`.
+        Updated with the content as it is written, for example
+        `hashlib.sha256()`.
+    :param offset: int, optional, default 0.
+        If non-zero, the response is the remainder of the file starting at
+        this byte (a "206 Partial Content" response) and it is appended to
+        the existing file; the progress and the size returned include the
+        existing part of the file.
+
+    :returns: int, the size of the file
+    """
+    total = response.headers.get('Content-Length')
+    total = int(total) + offset if total and total.isdigit() else None
+
+    done = offset
+    try:
+        with open(filename, 'ab' if offset else 'wb') as fh:
+            for chunk in response.iter_content(chunk_size):
+                if not chunk:
+                    continue
+                fh.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        response.close()
+
+    logger.debug("Wrote %d bytes to %s", done, filename)
+    return done
+
+
+def file_digest(filename, algorithm='sha1', chunk_size=1024*1024):
+    """ return the hex digest of the content of a file
+
+    :param filename: str, the file to hash
+    :param algorithm: str, optional, default 'sha1'.
+        The name of the hashlib algorithm to use
+    """
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PartialDownload:
+    """ An interrupted download kept on disk so that it can be resumed
+
+    The content downloaded so far is kept in `filename.part` and the
+    validators of the response (ETag or Last-Modified) that it came from
+    are kept in the sidecar file `filename.part.json`. The download can
+    only be resumed if the server still has the same version of the file.
+
+    :param filename: str, the final name of the downloaded file
+    """
+    suffix = '.part'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.part = filename + self.suffix
+        self.state_file = self.part + '.json'
+
+    @staticmethod
+    def validator(response):
+        """ the value for an If-Range header for the response, or `None`
+
+        Weak ETags cannot be used to resume downloads.
+        """
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.get('Last-Modified')
+
+    def load(self):
+        """ return the saved state of the download or `None` """
+        try:
+            with open(self.state_file) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def offset(self, response):
+        """ the number of bytes that can be reused for the response
+
+        returns: int, 0 if there is no partial download or it does not
+            belong to the same version of the file
+        """
+        state = self.load()
+        if state is None or not os.path.exists(self.part):
+            return 0
+
+        validator = self.validator(response)
+        if validator is None or state.get('validator') != validator:
+            logger.debug("Partial download of %s is out of date",
+                         self.filename)
+            return 0
+
+        size = os.path.getsize(self.part)
+        if state.get('size') is not None and size > state['size']:
+            return 0
+        return size
+
+    def begin(self, response):
+        """ record the state of a new download before it starts """
+        size = response.headers.get('Content-Length')
+        state = {
+            'url': response.url,
+            'validator': self.validator(response),
+            'size': int(size) if size and size.isdigit() else None,
+        }
+        with open(self.state_file, 'w') as fh:
+            json.dump(state, fh)
+
+    def complete(self):
+        """ move the finished download into place """
+        os.replace(self.part, self.filename)
+        self.discard()
+
+    def discard(self):
+        """ remove the partial download and its state """
+        for name in (self.part, self.state_file):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def hash_into(self, digest, chunk_size=1024*1024):
+        """ update a hash object with the content downloaded so far """
+        with open(self.part, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                digest.update(chunk)
+
+
+class MultipartStream:
+    """ A multipart/form-data request body that is read from disk as sent
+
+    The files are not read into memory: the body is produced in chunks as
+    the request is sent, so that large files can be uploaded with constant
+    memory use. The length of the body is known in advance so that the
+    request can be sent with a Content-Length header.
+
+    >>> body = MultipartStream({'itemid': 1234},
+    ...                        {'repo_upload_file': 'lecture.mp4'})
+    >>> session.post(url, data=body,
+    ...              headers={'Content-Type': body.content_type})
+
+    :param fields: dict of str, the simple form fields
+    :param files: dict, the files to send keyed by form field name; each
+        value is the filename or a tuple of (filename to send, filename
+        on disk)
+    :param progress: callable, optional, default `None`.
+        Called as `progress(done, total)` with the number of bytes of the
+        body that have been sent so far and the size of the whole body.
+    :param chunk_size: int, optional, default 1 MiB.
+        The size of the chunks produced when iterating over the body
+    """
+    def __init__(self, fields, files, progress=None, chunk_size=1024*1024):
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+        # each part is either bytes or the name of a file to be read
+        self._parts = []
+        for name, value in fields.items():
+            self._parts.append(self._header(name) + b'\r\n' +
+                               str(value).encode('utf-8') + b'\r\n')
+
+        for name, value in files.items():
+            sendname, path = value if isinstance(value, tuple) \
+                else (os.path.basename(value), value)
+            content_type = mimetypes.guess_type(sendname)[0] or \
+                'application/octet-stream'
+            self._parts.append(
+                self._header(name, sendname) +
+                ('Content-Type: %s\r\n\r\n' % content_type).encode('utf-8'))
+            self._parts.append(path)
+            self._parts.append(b'\r\n')
+
+        self._parts.append(('--%s--\r\n' % self.boundary).encode('ascii'))
+
+        self._length = sum(
+            os.path.getsize(p) if isinstance(p, str) else len(p)
+            for p in self._parts
+        )
+        self._done = 0
+        self._current = None
+
+    def _header(self, name, filename=None):
+        """ the boundary and Content-Disposition header of a part """
+        disposition = 'form-data; name="%s"' % name.replace('"', '%22')
+        if filename is not None:
+            disposition += '; filename="%s"' % filename.replace('"', '%22')
+        return ('--%s\r\nContent-Disposition: %s\r\n' %
+                (self.boundary, disposition)).encode('utf-8')
+
+    @property
+    def content_type(self):
+        """ the value of the Content-Type header for the request """
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self._length
+
+    def _next_part(self):
+        """ make the next part of the body the current one """
+        part = self._parts.pop(0)
+        if isinstance(part, str):
+            self._current = open(part, 'rb')
+        else:
+            self._current = io.BytesIO(part)
+
+    def read(self, size=-1):
+        """ return up to `size` bytes of the body; b'' when it is finished """
+        if size is None or size < 0:
+            size = self._length
+
+        chunks = []
+        wanted = size
+        while wanted > 0:
+            if self._current is None:
+                if not self._parts:
+                    break
+                self._next_part()
+            chunk = self._current.read(wanted)
+            if not chunk:
+                self._current.close()
+                self._current = None
+                continue
+            chunks.append(chunk)
+            wanted -= len(chunk)
+
+        data = b''.join(chunks)
+        if data:
+            self._done += len(data)
+            if self.progress is not None:
+                self.progress(self._done, self._length)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')